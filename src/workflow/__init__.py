@@ -25,6 +25,14 @@ dj.config["custom"]["processed_root_data_dir"] = os.getenv(
     "PROCESSED_ROOT_DATA_DIR", dj.config["custom"].get("processed_root_data_dir", "")
 )
 
+dj.config["custom"]["trace_cache_dir"] = os.getenv(
+    "TRACE_CACHE_DIR", dj.config["custom"].get("trace_cache_dir", "")
+)
+
+dj.config["custom"]["plot_cache_dir"] = os.getenv(
+    "PLOT_CACHE_DIR", dj.config["custom"].get("plot_cache_dir", "")
+)
+
 DB_PREFIX: str = dj.config["custom"].get("database.prefix", "")
 ORG_NAME, WORKFLOW_NAME, *_ = DB_PREFIX.split("_")
 SUPPORT_DB_PREFIX = f"{ORG_NAME}_support_{WORKFLOW_NAME}_"
@@ -35,3 +43,17 @@ WORKER_MAX_IDLED_CYCLE = int(
         "WORKER_MAX_IDLED_CYCLE", dj.config["custom"].get("worker_max_idled_cycle", 3)
     )
 )
+INSERT_BATCH_SIZE = int(
+    os.getenv("INSERT_BATCH_SIZE", dj.config["custom"].get("insert_batch_size", 1000))
+)
+# 0 disables eviction (e.g. for a cache shared between hosts, cleaned up externally)
+TRACE_CACHE_MAX_GB = float(
+    os.getenv("TRACE_CACHE_MAX_GB", dj.config["custom"].get("trace_cache_max_gb", 20))
+)
+# 0 disables eviction
+PLOT_CACHE_MAX_GB = float(
+    os.getenv("PLOT_CACHE_MAX_GB", dj.config["custom"].get("plot_cache_max_gb", 5))
+)
+PRECOMPUTE_PLOTS = os.getenv(
+    "PRECOMPUTE_PLOTS", str(dj.config["custom"].get("precompute_plots", True))
+).lower() in ("true", "1", "yes")
@@ -5,6 +5,7 @@ from scipy import signal
 import os
 
 from workflow import DB_PREFIX, ORG_NAME, WORKFLOW_NAME
+from workflow.utils.insert_buffer import InsertBuffer
 
 from .ephys import ephys
 
@@ -50,7 +51,7 @@ class SpectralBand(dj.Lookup):
 class LFPQC(dj.Computed):
     """
     Time-domain QC metrics for each LFP trace (per electrode).
-    Includes variance, noise level, and waveform shape (skewness/kurtosis).
+    Includes variance, noise level, waveform shape (skewness/kurtosis), line noise, clipping and flatlines.
     """
 
     definition = """
@@ -60,28 +61,46 @@ class LFPQC(dj.Computed):
     lfp_noise_level: float # Median absolute deviation (noise level estimate, uV)
     lfp_skewness: float # Skewness of the voltage distribution (Asymmetry)
     lfp_kurtosis: float # Kurtosis of the voltage distribution (Tail heaviness)
+    lfp_line_noise_power=null: float # Power of the line noise sinusoid (uV^2)
+    lfp_clipping_fraction=null: float # Fraction of samples at the trace minimum or maximum
+    lfp_flatline_fraction=null: float # Fraction of consecutive samples with identical values
     """
 
+    line_freq = 60.0  # Hz, line noise frequency
+
+    @property
+    def key_source(self):
+        # Session level - all electrodes of a session are computed in one job
+        return ephys.LFP
+
     def make(self, key):
         import scipy.stats as stats
 
-        lfp = (ephys.LFP.Trace & key).fetch1("lfp")
+        # Load the LFP traces of all electrodes and the sampling rate
+        trace_keys, lfps = (ephys.LFP.Trace & key).fetch("KEY", "lfp")
+        fs = (ephys.LFP & key).fetch1("lfp_sampling_rate")
+        lfps = np.stack(lfps)
 
-        # Standard deviation (variance)
-        lfp_std = float(np.std(lfp))
+        # Moments, line noise, clipping and flatlines in one streaming pass
+        qc_metrics = _compute_qc_metrics(lfps, fs, line_freq=self.line_freq)
 
         # Median absolute deviation
-        lfp_noise_level = float(stats.median_abs_deviation(lfp))
-
-        # Waveform shape
-        self.insert1(
-            {
-                **key,
-                "lfp_std": lfp_std,
-                "lfp_noise_level": lfp_noise_level,
-                "lfp_skewness": stats.skew(lfp),
-                "lfp_kurtosis": stats.kurtosis(lfp),
-            }
+        lfp_noise_level = stats.median_abs_deviation(lfps, axis=1)
+
+        self.insert(
+            [
+                {
+                    **trace_key,
+                    "lfp_std": qc_metrics["std"][i],
+                    "lfp_noise_level": lfp_noise_level[i],
+                    "lfp_skewness": qc_metrics["skewness"][i],
+                    "lfp_kurtosis": qc_metrics["kurtosis"][i],
+                    "lfp_line_noise_power": qc_metrics["line_noise_power"][i],
+                    "lfp_clipping_fraction": qc_metrics["clipping_fraction"][i],
+                    "lfp_flatline_fraction": qc_metrics["flatline_fraction"][i],
+                }
+                for i, trace_key in enumerate(trace_keys)
+            ]
         )
 
 
@@ -117,7 +136,7 @@ class LFPSpectrogram(dj.Computed):
         definition = """
         -> master
         ---
-        spectrogram: blob@datajoint-blob  # Spectrogram matrix (freq x time) (μV²/Hz)
+        spectrogram: blob@datajoint-blob  # Spectrogram matrix (freq x time) (μV²/Hz) - float16 is log10 power, read with `fetch_spectrograms`
         time: blob@datajoint-blob         # Time bins (s)
         frequency: blob@datajoint-blob    # Frequency bins (Hz)
         """
@@ -134,85 +153,295 @@ class LFPSpectrogram(dj.Computed):
         std_power: float             # Std dev of band power (μV²/Hz)
         """
 
+    # parameter sets computed together in one pass over the traces of a session
+    param_indices = (0, 1, 2)
+
+    # spectrogram storage
+    # "float64": full precision, "float32" or "log_float16" (log10 power): compact
+    # time and frequency bins are identical for all electrodes - the external store keeps a single copy (content-addressed)
+    spectrogram_storage = "float64"
+    spectrogram_max_freq = (
+        None  # Hz, spectrograms are truncated above this frequency (None to keep all)
+    )
+
     @property
     def key_source(self):
-        # Use only the default param_idx for high-gamma windowing params for automated population
-        return ephys.LFP.Trace * SpectrogramParameters & "param_idx=2"
+        # Session level - one job per session computes all of its missing parameter sets
+        # (each session is keyed by its first missing param_idx, so there is a single job per session)
+        missing = (
+            ephys.LFP * SpectrogramParameters
+            & [{"param_idx": param_idx} for param_idx in self.param_indices]
+        ) - self.proj()
+        session_keys = {}
+        for missing_key in missing.fetch("KEY", order_by="param_idx DESC"):
+            lfp_key = tuple(missing_key[k] for k in ephys.LFP.primary_key)
+            session_keys[lfp_key] = missing_key
+        return missing & list(session_keys.values())
 
     def make(self, key):
-        # Load LFP trace and sampling rate
-        lfp = (ephys.LFP.Trace & key).fetch1("lfp")
-        fs = (ephys.LFP & key).fetch1("lfp_sampling_rate")
-
-        # Spectrogram window parameters
-        window_size, overlap_size = (SpectrogramParameters & key).fetch1(
-            "window_size", "overlap_size"
-        )
-        nperseg = int(window_size * fs)
-        noverlap = int(overlap_size * fs)
-
-        # Compute spectrogram as Power Spectral Density (PSD) (μV²/Hz)
-        freq, t, Sxx = signal.spectrogram(
-            lfp,
-            fs=fs,
-            window="tukey",
-            nperseg=nperseg,
-            noverlap=noverlap,
-            scaling="density",
-            mode="psd",
-        )
-
-        # Insert temporary values for non-nullable secondary attributes; will update with computed metrics below.
-        self.insert1(
-            {
-                **key,
-                "delta_band_mean_power": 0.0,
-                "power_range_90pct": 0.0,
-            }
-        )
+        # Parameter sets of this session that are not computed yet
+        lfp_key = (ephys.LFP & key).fetch1("KEY")
+        computed_params = set((self & lfp_key).fetch("param_idx"))
+        params = (
+            SpectrogramParameters
+            & [
+                {"param_idx": param_idx}
+                for param_idx in self.param_indices
+                if param_idx not in computed_params
+            ]
+        ).fetch(as_dict=True)
+
+        # Load the LFP traces of all electrodes and the sampling rate (once for all parameter sets)
+        trace_keys, lfps = (ephys.LFP.Trace & lfp_key).fetch("KEY", "lfp")
+        fs = (ephys.LFP & lfp_key).fetch1("lfp_sampling_rate")
+        lfps = np.stack(lfps)
+        bands = SpectralBand.fetch(as_dict=True)
+        band_names = [band["band_name"] for band in bands]
+
+        for param in params:
+            param_key = {"param_idx": param["param_idx"]}
+            freq, t, Sxx, band_powers = _compute_spectrograms(
+                lfps, fs, param["window_size"], param["overlap_size"], bands
+            )
 
-        self.ChannelSpectrogram.insert1(
-            {
-                **key,
-                "spectrogram": Sxx,
-                "frequency": freq,
-                "time": t,
-            }
-        )
+            # Compute session-level summary metrics
+            # broadband RMS amplitude envelope
+            amp_envelope = np.sqrt(np.mean(Sxx, axis=1))
+            power_range_90pct = np.percentile(amp_envelope, 95, axis=1) - np.percentile(
+                amp_envelope, 5, axis=1
+            )
+            delta_mean_power = (
+                band_powers[:, band_names.index("delta")].mean(axis=1)
+                if "delta" in band_names
+                else np.zeros(len(trace_keys))
+            )
 
-        # Compute band power metrics
-        band_powers = {}
-        for band in (SpectralBand()).fetch(as_dict=True):
-            band_mask = (freq >= band["lower_freq"]) & (freq < band["upper_freq"])
-            band_power = (
-                Sxx[band_mask].mean(axis=0) if band_mask.any() else np.zeros_like(t)
+            self.insert(
+                [
+                    {
+                        **trace_key,
+                        **param_key,
+                        "delta_band_mean_power": delta_mean_power[i],
+                        "power_range_90pct": float(power_range_90pct[i]),
+                    }
+                    for i, trace_key in enumerate(trace_keys)
+                ]
             )
-            band_powers[band["band_name"]] = band_power
 
-            self.ChannelPower.insert1(
-                {
-                    **key,
-                    "band_name": band["band_name"],
-                    "power_time_series": band_power,
-                    "mean_power": band_power.mean(),
-                    "std_power": band_power.std(),
-                }
+            # Stored spectrograms (band powers above use the full spectrograms)
+            freq_mask = (
+                freq <= self.spectrogram_max_freq
+                if self.spectrogram_max_freq is not None
+                else np.ones(len(freq), dtype=bool)
             )
+            stored_Sxx = _encode_spectrograms(
+                Sxx[:, freq_mask], self.spectrogram_storage
+            )
+            axes = {"frequency": freq[freq_mask], "time": t}
+
+            with InsertBuffer(self.ChannelSpectrogram) as spectrogram_buffer:
+                for i, trace_key in enumerate(trace_keys):
+                    spectrogram_buffer.add(
+                        {
+                            **trace_key,
+                            **param_key,
+                            "spectrogram": stored_Sxx[i],
+                            **axes,
+                        }
+                    )
+
+            with InsertBuffer(self.ChannelPower) as power_buffer:
+                for i, trace_key in enumerate(trace_keys):
+                    for band_name, band_power in zip(band_names, band_powers[i]):
+                        power_buffer.add(
+                            {
+                                **trace_key,
+                                **param_key,
+                                "band_name": band_name,
+                                "power_time_series": band_power,
+                                "mean_power": band_power.mean(),
+                                "std_power": band_power.std(),
+                            }
+                        )
+
+
+def _compute_spectrograms(lfps, fs, window_size, overlap_size, bands):
+    """
+    Spectrograms and band powers of all electrodes for one set of window parameters.
+    Args:
+        lfps: (electrodes x samples) LFP traces
+        fs: sampling frequency in Hz
+        window_size: window size in seconds
+        overlap_size: window overlap in seconds
+        bands: list of `SpectralBand` entries
+
+    Returns:
+        freq: (freq,) frequency bins in Hz
+        t: (time,) time bins in seconds
+        Sxx: (electrodes x freq x time) Power Spectral Density (μV²/Hz)
+        band_powers: (electrodes x bands x time) mean power in each band (μV²/Hz)
+    """
+    nperseg = int(window_size * fs)
+    noverlap = int(overlap_size * fs)
+
+    # Compute spectrograms of all electrodes as Power Spectral Density (PSD) (μV²/Hz)
+    freq, t, Sxx = signal.spectrogram(
+        lfps,
+        fs=fs,
+        window="tukey",
+        nperseg=nperseg,
+        noverlap=noverlap,
+        scaling="density",
+        mode="psd",
+        axis=-1,
+    )
+
+    # Compute band powers of all bands and electrodes with one frequency-mask matrix multiply
+    band_masks = np.array(
+        [(freq >= band["lower_freq"]) & (freq < band["upper_freq"]) for band in bands]
+    )
+    band_weights = band_masks / np.maximum(band_masks.sum(axis=1, keepdims=True), 1)
+    band_powers = band_weights @ Sxx
+
+    return freq, t, Sxx, band_powers
+
+
+def _encode_spectrograms(Sxx, storage="float64"):
+    """
+    Encode spectrograms for storage (see `LFPSpectrogram.spectrogram_storage`).
+    """
+    if storage == "float64":
+        return Sxx
+    if storage == "float32":
+        return Sxx.astype(np.float32)
+    if storage == "log_float16":
+        with np.errstate(divide="ignore"):
+            return np.log10(Sxx).astype(np.float16)
+    raise ValueError(f"Unknown spectrogram storage: {storage}")
 
-        # Compute delta/alpha power ratio
-        delta_power = band_powers.get("delta", np.zeros_like(t))
 
-        # Compute session-level summary metrics
-        amp_envelope = np.sqrt(np.mean(Sxx, axis=0))  # broadband RMS amplitude envelope
-        power_range_90pct = float(
-            np.percentile(amp_envelope, 95) - np.percentile(amp_envelope, 5)
-        )
+def decode_spectrogram(spectrogram):
+    """
+    Decode a stored spectrogram to power (μV²/Hz) as float64 (float16 spectrograms are stored as log10 power).
+    """
+    spectrogram = np.asarray(spectrogram)
+    if spectrogram.dtype == np.float16:
+        return 10.0 ** spectrogram.astype(np.float64)
+    return spectrogram.astype(np.float64)
+
 
-        # Insert final computed summary metrics
-        self.update1(
-            {
-                **key,
-                "delta_band_mean_power": delta_power.mean(),
-                "power_range_90pct": power_range_90pct,
-            }
+def fetch_spectrograms(restriction):
+    """
+    Fetch `LFPSpectrogram.ChannelSpectrogram` entries with decoded spectrograms, whichever storage mode they were
+    stored with. The time and frequency bins (shared by all electrodes) are downloaded once per session and parameter set.
+    Args:
+        restriction: restriction on `LFPSpectrogram.ChannelSpectrogram`
+
+    Returns:
+        entries: list of dicts (as `fetch(as_dict=True)`)
+    """
+    entries = (LFPSpectrogram.ChannelSpectrogram & restriction).fetch(
+        "KEY", "spectrogram", as_dict=True
+    )
+
+    axes_attrs = [k for k in LFPSpectrogram.primary_key if k != "electrode"]
+    session_axes = {}
+    for entry in entries:
+        axes_key = tuple(entry[k] for k in axes_attrs)
+        if axes_key not in session_axes:
+            entry_key = {k: entry[k] for k in LFPSpectrogram.primary_key}
+            session_axes[axes_key] = (
+                LFPSpectrogram.ChannelSpectrogram & entry_key
+            ).fetch1("time", "frequency")
+        entry["spectrogram"] = decode_spectrogram(entry["spectrogram"])
+        entry["time"], entry["frequency"] = session_axes[axes_key]
+    return entries
+
+
+def _compute_qc_metrics(lfps, fs, line_freq=60.0, chunk_size=65536):
+    """
+    QC metrics of all traces, streamed over chunks of samples so every sample is read once.
+    Args:
+        lfps: (electrodes x samples) LFP traces
+        fs: sampling frequency in Hz
+        line_freq: line noise frequency in Hz
+        chunk_size: number of samples per chunk
+
+    Returns:
+        qc_metrics: dict of (electrodes,) arrays - "std", "skewness" and "kurtosis" (biased, Fisher, as
+            `np.std`, `scipy.stats.skew` and `scipy.stats.kurtosis`), "line_noise_power" (uV^2),
+            "clipping_fraction" and "flatline_fraction"
+    """
+    num_channels, num_samples = lfps.shape
+
+    # power sums are accumulated around a shift (mean of the first chunk) for numerical stability
+    shift = lfps[:, :chunk_size].mean(axis=1, keepdims=True)
+    power_sums = np.zeros((4, num_channels))
+    line_phasor = np.zeros(num_channels, dtype=complex)
+    trace_min, trace_max = np.full(num_channels, np.inf), np.full(num_channels, -np.inf)
+    min_count, max_count = np.zeros(num_channels), np.zeros(num_channels)
+    flat_count = np.zeros(num_channels)
+
+    for start in range(0, num_samples, chunk_size):
+        raw_chunk = lfps[:, start : start + chunk_size]
+        chunk = raw_chunk - shift
+        chunk_2 = chunk * chunk
+        power_sums[0] += chunk.sum(axis=1)
+        power_sums[1] += chunk_2.sum(axis=1)
+        power_sums[2] += (chunk_2 * chunk).sum(axis=1)
+        power_sums[3] += (chunk_2 * chunk_2).sum(axis=1)
+
+        # projection onto the line noise frequency
+        sample_times = np.arange(start, start + raw_chunk.shape[1]) / fs
+        line_phasor += chunk @ np.exp(-2j * np.pi * line_freq * sample_times)
+
+        # number of samples at the running minimum / maximum
+        chunk_min, chunk_max = raw_chunk.min(axis=1), raw_chunk.max(axis=1)
+        chunk_min_count = (raw_chunk == chunk_min[:, None]).sum(axis=1)
+        chunk_max_count = (raw_chunk == chunk_max[:, None]).sum(axis=1)
+        min_count = np.where(
+            chunk_min < trace_min,
+            chunk_min_count,
+            min_count + np.where(chunk_min == trace_min, chunk_min_count, 0),
+        )
+        max_count = np.where(
+            chunk_max > trace_max,
+            chunk_max_count,
+            max_count + np.where(chunk_max == trace_max, chunk_max_count, 0),
+        )
+        trace_min = np.minimum(trace_min, chunk_min)
+        trace_max = np.maximum(trace_max, chunk_max)
+
+        # consecutive identical samples (including the step from the previous chunk)
+        flat_count += (
+            np.diff(lfps[:, max(start - 1, 0) : start + chunk_size], axis=1) == 0
+        ).sum(axis=1)
+
+    # central moments from the power sums
+    mean = power_sums[0] / num_samples
+    raw_moments = power_sums / num_samples
+    m2 = raw_moments[1] - mean**2
+    m3 = raw_moments[2] - 3 * mean * raw_moments[1] + 2 * mean**3
+    m4 = (
+        raw_moments[3]
+        - 4 * mean * raw_moments[2]
+        + 6 * mean**2 * raw_moments[1]
+        - 3 * mean**4
+    )
+    m2 = np.maximum(m2, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        skewness = m3 / m2**1.5
+        kurtosis = m4 / m2**2 - 3
+
+    return {
+        "std": np.sqrt(m2),
+        "skewness": skewness,
+        "kurtosis": kurtosis,
+        "line_noise_power": 2 * np.abs(line_phasor) ** 2 / num_samples**2,
+        "clipping_fraction": np.where(
+            trace_min == trace_max, num_samples, min_count + max_count
         )
+        / num_samples,
+        "flatline_fraction": flat_count / max(num_samples - 1, 1),
+    }
@@ -2,15 +2,18 @@
 import datajoint as dj
 from workflow import DB_PREFIX, ORG_NAME, WORKFLOW_NAME
 from workflow.pipeline import culture, ephys, mua, probe, analysis
+from workflow.utils.insert_buffer import InsertBuffer
+from workflow.utils.signal_utils import add_population_minutes, bandpass_filter, band_power_envelope, build_population_rate
 from element_interface.utils import find_full_path
 from element_array_ephys.ephys_no_curation import get_ephys_root_data_dir
 
 import os
+from functools import lru_cache
 import intanrhdreader
 import numpy as np
-from random import randint
 import bottleneck as bn
-from scipy.signal import find_peaks, coherence, butter, sosfiltfilt, hilbert
+from scipy import fft as sp_fft
+from scipy.signal import find_peaks, get_window
 from scipy.interpolate import interp1d
 from scipy.ndimage import gaussian_filter1d
 from specparam import SpectralModel
@@ -59,6 +62,48 @@ class NumElectrodesInside(dj.Lookup):
         ("O29", 22), ("O30", 20), ("O31", 20), ("O32", 20), # Control Batch 4
     ]
 
+@schema
+class PopulationRate(dj.Computed):
+    """
+    Per-minute population activity of the electrodes inside the organoid (summarizes `mua.MUASpikes.Channel`).
+    """
+
+    definition = """
+    -> mua.MUASpikes
+    ---
+    population_rate: float  # Summed spike rate of the electrodes inside the organoid (Hz)
+    active_electrodes: int  # Number of electrodes inside the organoid with at least one spike
+    spike_count: int  # Summed spike count of the electrodes inside the organoid
+    index (organoid_id, start_time)
+    """
+
+    key_source = mua.MUASpikes & NumElectrodesInside
+
+    def populate(self, *restrictions, **kwargs):
+        # pick up corrected electrode configs (cached within a populate call)
+        clear_electrode_caches()
+        return super().populate(*restrictions, **kwargs)
+
+    def make(self, key):
+
+        # fetch electrode parameters
+        num_elec_inside = (NumElectrodesInside & key).fetch1('num_electrodes')
+
+        # fetch MUA values of all channels
+        spike_rates, spike_counts, channel_ids = (mua.MUASpikes.Channel & key).fetch('spike_rate', 'spike_count', 'channel_idx')
+
+        # only consider electrodes inside organoid
+        electrode_config_hash = get_electrode_config_hash(key['organoid_id'], key['experiment_start_time'])
+        electrode_ids = map_channel_to_electrode(channel_ids, electrode_config_hash)
+        inside = (electrode_ids >= 0) & (electrode_ids < num_elec_inside)
+
+        self.insert1({
+            **key,
+            'population_rate': spike_rates[inside].sum(),
+            'active_electrodes': np.count_nonzero(spike_counts[inside]),
+            'spike_count': spike_counts[inside].sum(),
+        })
+
 @schema
 class TimeFrameParamset(dj.Lookup):
     """
@@ -112,30 +157,32 @@ class FrameAnalysis(dj.Computed):
         frame_firing_rate: float # Firing rates for each frame
         """
 
-    def make(self, key):
-        
-        # fetch electrode parameters
-        num_elec_inside = (NumElectrodesInside & key).fetch1('num_electrodes')
-
-        # fetch frame parameters
-        num_frames, min_per_frame = (TimeFrameParamset & key).fetch1('num_frames', 'min_per_frame')
+    class PopulationActivity(dj.Part):
+        """
+        Per-minute population firing rate within the analysis boundaries (extended with `FrameAnalysis.extend` as new MUA minutes arrive).
+        """
 
-        # fetch MUA values (needs to be previously )
-        spike_rates, start_times, channel_ids = (mua.MUASpikes.Channel & 
-                                                 f"organoid_id='{key['organoid_id']}'" &
-                                                 f"start_time BETWEEN '{key['start_boundary']}' AND '{key['end_boundary']}'"
-                                                 ).fetch('spike_rate', 'start_time', 'channel_idx')
-        
-        # convert channel ids to electrode indices
-        electrode_ids = map_channel_to_electrode(channel_ids)
+        definition = """
+        -> master
+        ---
+        grid_start: datetime # Start of the first minute of the population firing vectors
+        last_start_time: datetime # Start time of the last MUA minute included (informational - new minutes are found by their start_time_offsets)
+        population_firing_vector: longblob # Summed firing rate of the electrodes inside the organoid for each minute (Hz)
+        smoothed_firing_vector: longblob # Population firing vector filtered with a boxcar of length min_per_frame
+        start_time_offsets: longblob # Start times of the included MUA minutes (seconds from grid_start)
+        """
 
-        time_vector, population_firing_vector = create_population_firing_vector(spike_rates, start_times, electrode_ids, num_elec_inside)
+    @property
+    def key_source(self):
+        # only sessions whose MUA minutes within the boundaries are all summarized in PopulationRate
+        pending_minutes = (mua.MUASpikes - PopulationRate).proj(mua_start_time='start_time', mua_experiment_start_time='experiment_start_time')
+        incomplete_sessions = (FrameSession * pending_minutes) & 'mua_start_time BETWEEN start_boundary AND end_boundary'
+        return FrameSession - incomplete_sessions.proj()
 
-        # filter population firing vector - boxcar with the length of min_per_frame
-        population_firing_vector = bn.move_mean(population_firing_vector, window=min_per_frame, min_count=1)
+    def make(self, key):
 
-        # find active frames
-        active_frames = find_active_frames(start_times, time_vector, population_firing_vector, num_frames, min_per_frame)
+        # compute the population activity and active frames
+        activity, active_frames = compute_population_activity(key)
 
         # find probe info
         port_id = set((ephys.EphysSessionProbe & key).fetch("port_id"))
@@ -161,6 +208,7 @@ class FrameAnalysis(dj.Computed):
 
         # insert the parent FrameAnalysis record
         self.insert1(key)
+        self.PopulationActivity.insert1({**key, **activity})
 
         # insert active frames (and acompannying ephys sessions)
         for active_frame in active_frames:
@@ -193,84 +241,260 @@ class FrameAnalysis(dj.Computed):
                 'frame_firing_rate': active_frame['frame_firing_rate'],
             })            
 
+    def extend(self, *restrictions):
+        """
+        Add the MUA minutes that are not included yet (in any order) to the population activity and update the active
+        frames, without refetching the minutes already included.
+
+        Args:
+            *restrictions: Restrictions on `FrameAnalysis` (all entries if empty).
+        """
+        for key in (self & dj.AndList(restrictions)).fetch("KEY"):
+
+            if not (self.key_source & key):
+                logger.info(f"PopulationRate does not cover all MUA minutes of {key} yet - skipping")
+                continue
+
+            previous = (self.PopulationActivity & key).fetch(as_dict=True)
+            activity, active_frames = compute_population_activity(key, previous[0] if previous else None)
+            if previous and len(activity["start_time_offsets"]) == len(previous[0]["start_time_offsets"]):
+                continue  # no new MUA minutes
+
+            existing_frames = set(zip(*(self.ActiveTimeFrames & key).fetch('frame_start', 'frame_end')))
+            new_frames = {
+                (active_frame['frame_start'], active_frame['frame_end']): {**key, **active_frame}
+                for active_frame in active_frames
+            }
+
+            with self.connection.transaction:
+                if previous:
+                    self.PopulationActivity.update1({**key, **activity})
+                else:
+                    self.PopulationActivity.insert1({**key, **activity})
+
+                # remove frames that are no longer among the most active ones
+                for frame_start, frame_end in existing_frames:
+                    if (frame_start, frame_end) not in new_frames:
+                        (self.ActiveTimeFrames & key & {'frame_start': frame_start, 'frame_end': frame_end}).delete_quick()
+
+                # add new frames and update the firing rates of the existing ones
+                for frame_bounds, frame in new_frames.items():
+                    if frame_bounds in existing_frames:
+                        self.ActiveTimeFrames.update1(frame)
+                    else:
+                        self.ActiveTimeFrames.insert1(frame)
+
 
 # Helpful Functions
-def map_channel_to_electrode(channel_ids):
+@lru_cache(maxsize=None)
+def get_electrode_config_hash(organoid_id, experiment_start_time):
+    """electrode_config_hash of the probe used in an organoid experiment (cached, see `clear_electrode_caches`)."""
+
+    config_hashes = set((ephys.EphysSessionProbe * probe.Probe * probe.ElectrodeConfig &
+                         {'organoid_id': organoid_id, 'experiment_start_time': experiment_start_time}
+                         ).fetch('electrode_config_hash'))
+    if len(config_hashes) != 1:
+        raise ValueError(
+            f"Expected one electrode config for {organoid_id} ({experiment_start_time}), found {len(config_hashes)}"
+        )
+    return config_hashes.pop()
 
-    electrode_mapping, channel_mapping = probe.ElectrodeConfig.Electrode.fetch("electrode", "channel_idx")
+@lru_cache(maxsize=None)
+def get_electrode_lookup(electrode_config_hash=None):
+    """
+    Channel to electrode lookup table of an electrode config (cached per electrode_config_hash, see `clear_electrode_caches`).
 
-    # create lookup to convert
-    lookup = np.empty(32, dtype=int)
-    lookup[channel_mapping] = electrode_mapping
+    Args:
+        electrode_config_hash (uuid, optional): Electrode config. Defaults to None (all electrode configs, only valid if they share the channel map).
 
-    # correctly map electrode indices
-    electrode_ids = lookup[channel_ids]
-    
-    return electrode_ids
+    Returns:
+        np.ndarray: Read-only array with the electrode index of each channel index (-1 for unmapped channels).
+    """
+    restriction = {'electrode_config_hash': electrode_config_hash} if electrode_config_hash is not None else {}
+    electrode_mapping, channel_mapping = (probe.ElectrodeConfig.Electrode & restriction).fetch("electrode", "channel_idx")
 
-def create_population_firing_vector(spike_rates, start_times, electrode_ids, num_elec_inside):
+    # create lookup to convert (sized to the probe)
+    lookup = np.full(channel_mapping.max() + 1 if len(channel_mapping) else 0, -1, dtype=int)
+    lookup[channel_mapping.astype(int)] = electrode_mapping
+    lookup.flags.writeable = False
 
-    # create full time vector from recording start to end (1 minute increments)
-    unique_start_times = np.unique(start_times)
-    time_vector = np.arange(min(unique_start_times.astype("datetime64[m]")), max(unique_start_times.astype("datetime64[m]"))+np.timedelta64(1, 'm'), np.timedelta64(1, 'm')) # full array of recording timeline (needed to account for missing data)
-    population_firing_vector = np.zeros(time_vector.shape)    
+    return lookup
 
-    # loop through start times and insert data into population firing vector
-    for start_time in unique_start_times:
+def clear_electrode_caches():
+    """
+    Clear the cached electrode configs and channel to electrode lookups.
 
-        time_bool = (start_times == start_time)
+    electrode_config_hash only covers the electrodes of a config, not its channel map, so the caches are cleared at the
+    start of every populate of the tables using them (`PopulationRate`, `PopulationBursts`) to pick up corrected configs.
+    """
+    get_electrode_config_hash.cache_clear()
+    get_electrode_lookup.cache_clear()
 
-        # only consider electrodes inside organoid
-        elec_bool = (electrode_ids < num_elec_inside)
+def map_channel_to_electrode(channel_ids, electrode_config_hash=None):
+    """Convert channel indices to electrode indices (see `get_electrode_lookup`)."""
 
-        # sum valid electrodes for each time window (minute)
-        time_index = np.where(time_vector == np.datetime64(start_time, 'm'))[0][0]
-        population_firing_vector[time_index] = np.sum(spike_rates[time_bool & elec_bool])
+    # correctly map electrode indices
+    electrode_ids = get_electrode_lookup(electrode_config_hash)[np.asarray(channel_ids, dtype=int)]
     
-    return time_vector, population_firing_vector
+    return electrode_ids
 
-def find_active_frames(start_times, time_vector, population_firing_vector, num_frames, min_per_frame):
+def compute_population_activity(key, previous=None):
+    """Population activity and active frames of a `FrameSession`.
 
-    # find active frames
-    frame_indices, properties = find_peaks(population_firing_vector, height=0, distance=min_per_frame)
-    frame_amplitudes = properties['peak_heights']
+    Only the `PopulationRate` minutes that are not included in `previous` yet are fetched and binned (minutes may arrive
+    in any order); the boxcar-filtered vector is recomputed from the first new minute on.
 
-    # remove boundary peaks (these will raise an error when trying to extract burst windows)
-    boundary_bool = (min_per_frame <= frame_indices)
+    Args:
+        key (dict): `FrameSession` key.
+        previous (dict, optional): Previous `FrameAnalysis.PopulationActivity` entry to extend. Defaults to None.
 
-    frame_indices = frame_indices[boundary_bool]
-    frame_amplitudes = frame_amplitudes[boundary_bool]
-    
-    # find most active regions -> extract windows
-    active_frame_indices = frame_indices[np.argsort(frame_amplitudes)[-num_frames:]]  # indexes of the most active peaks
+    Returns:
+        activity (dict): `FrameAnalysis.PopulationActivity` attributes (without the key).
+        active_frames (list): Active frames (see `find_active_frames`).
+    """
+    # fetch frame parameters
+    num_frames, min_per_frame = (TimeFrameParamset & key).fetch1('num_frames', 'min_per_frame')
+
+    session_minutes = (PopulationRate & 
+                       f"organoid_id='{key['organoid_id']}'" &
+                       f"start_time BETWEEN '{key['start_boundary']}' AND '{key['end_boundary']}'")
+
+    if previous:
+        grid_start = np.datetime64(previous['grid_start'], 'm')
+        population_firing_vector = previous['population_firing_vector']
+        smoothed_firing_vector = previous['smoothed_firing_vector']
+        start_time_offsets = previous['start_time_offsets']
+    else:
+        grid_start = None
+        population_firing_vector = smoothed_firing_vector = np.zeros(0)
+        start_time_offsets = np.zeros(0, dtype=np.int64)
+
+    # fetch per-minute population rates of the minutes that are not included yet (antijoin on start_time, minutes may arrive in any order)
+    if previous:
+        available_start_times = np.asarray(session_minutes.fetch('start_time'), dtype="datetime64[s]")
+        included_start_times = grid_start.astype("datetime64[s]") + start_time_offsets * np.timedelta64(1, 's')
+        new_start_times = np.setdiff1d(available_start_times, included_start_times)
+        session_minutes &= [{'start_time': start_time.item()} for start_time in new_start_times]  # empty list - no minutes
+    population_rates, start_times = session_minutes.fetch('population_rate', 'start_time')
+
+    if not previous and not len(start_times):
+        raise ValueError(f"No MUA spikes found for {key}")
+
+    # add the new minutes to the per-minute grid and update the boxcar-filtered vector (length of min_per_frame)
+    grid_start, population_firing_vector, smoothed_firing_vector, start_time_offsets = add_population_minutes(
+        grid_start, population_firing_vector, smoothed_firing_vector, start_time_offsets,
+        start_times, population_rates, min_per_frame,
+    )
 
-    # account if not enough peaks -> use random windows
-    while len(active_frame_indices) < num_frames:
+    # find active frames
+    time_vector = grid_start + np.arange(len(population_firing_vector)) * np.timedelta64(1, 'm')
+    session_start_times = (grid_start + start_time_offsets * np.timedelta64(1, 's')).astype(object)
+    active_frames = find_active_frames(session_start_times, time_vector, smoothed_firing_vector, num_frames, min_per_frame)
+
+    activity = {
+        'grid_start': grid_start.item(),
+        'last_start_time': session_start_times.max(),
+        'population_firing_vector': population_firing_vector,
+        'smoothed_firing_vector': smoothed_firing_vector,
+        'start_time_offsets': start_time_offsets,
+    }
+    return activity, active_frames
+
+def find_active_frames(start_times, time_vector, population_firing_vector, num_frames, min_per_frame, seed=0):
+    """Select the `num_frames` most active non-overlapping frames of `min_per_frame` minutes.
+
+    Peaks of the population firing vector are taken in order of decreasing height; a peak is accepted if its frame does
+    not overlap an accepted frame. If there are not enough peaks, the remaining frames are drawn from the free positions
+    in a seeded random order. Only frames whose start and end minutes were recorded are considered, and every position
+    is visited at most once, so fewer than `num_frames` frames are returned if the recording is too short.
+
+    Args:
+        start_times (np.ndarray): Start times of the recorded MUA minutes.
+        time_vector (np.ndarray): Minute (datetime64) of each element of the population firing vector.
+        population_firing_vector (np.ndarray): (Smoothed) population firing rate per minute.
+        num_frames (int): Number of frames to select.
+        min_per_frame (int): Frame length in minutes.
+        seed (int, optional): Seed of the fallback selection. Defaults to 0.
+
+    Returns:
+        list: Dicts with frame_start, frame_end and frame_firing_rate, most active frame first.
+    """
+    population_firing_vector = np.asarray(population_firing_vector)
+    num_bins = len(population_firing_vector)
+
+    # start time of the recorded minute in each bin (NaT if not recorded)
+    start_times = np.asarray(start_times, dtype="datetime64[s]")
+    minute_start = np.full(num_bins, np.datetime64('NaT'), dtype="datetime64[s]")
+    start_bins = ((start_times.astype("datetime64[m]") - time_vector[0]) / np.timedelta64(1, 'm')).astype(int)
+    in_grid = (start_bins >= 0) & (start_bins < num_bins)
+    minute_start[start_bins[in_grid]] = start_times[in_grid]
+
+    # a frame ending at bin i spans bins [i - min_per_frame, i] - only frames with recorded bounds are valid
+    recorded = ~np.isnat(minute_start)
+    valid = np.zeros(num_bins, dtype=bool)
+    valid[min_per_frame:] = recorded[min_per_frame:] & recorded[:num_bins - min_per_frame]
+
+    # candidate frames - peaks in order of decreasing height, then the remaining positions in a seeded random order
+    peak_indices, properties = find_peaks(population_firing_vector, height=0, distance=min_per_frame)
+    peak_order = np.argsort(-properties['peak_heights'], kind='stable')
+    peak_indices = peak_indices[peak_order][valid[peak_indices[peak_order]]]
+
+    def iter_candidates():
+        yield from peak_indices
+        yield from np.random.default_rng(seed).permutation(np.flatnonzero(valid))
+
+    # greedy selection of non-overlapping frames (interval occupancy of the bins)
+    occupied = np.zeros(num_bins, dtype=bool)
+    active_frame_indices = []
+    for frame_idx in iter_candidates():
+        if len(active_frame_indices) == num_frames:
+            break
+        if occupied[frame_idx - min_per_frame:frame_idx + 1].any():
+            continue
+        occupied[frame_idx - min_per_frame:frame_idx + 1] = True
+        active_frame_indices.append(frame_idx)
+
+    if len(active_frame_indices) < num_frames:
+        logger.warning(f"Only {len(active_frame_indices)} of {num_frames} non-overlapping frames of {min_per_frame} minutes fit in the recording")
+
+    # frame metrics - mean firing rate over the frame
+    active_frame_indices = np.asarray(active_frame_indices, dtype=int)
+    cumulative_rate = np.concatenate([[0], np.cumsum(population_firing_vector)])
+    frame_firing_rates = (cumulative_rate[active_frame_indices] - cumulative_rate[active_frame_indices - min_per_frame]) / min_per_frame
+
+    return [
+        {
+            'frame_start': minute_start[frame_idx - min_per_frame].item(),
+            'frame_end': minute_start[frame_idx].item(),
+            'frame_firing_rate': frame_firing_rate,
+        }
+        for frame_idx, frame_firing_rate in zip(active_frame_indices, frame_firing_rates)
+    ]
 
-        rand_idx = randint(0, len(population_firing_vector))
+def find_active_frames_batch(*restrictions, seed=0):
+    """Active frames of many `FrameAnalysis` entries from their stored population activity, fetched in one query.
 
-        if not np.any(np.isin(np.arange(rand_idx-min_per_frame, rand_idx+1), active_frame_indices)):
-            active_frame_indices = np.concatenate([active_frame_indices, [rand_idx]])
-    
-    active_frames = []
-    for active_frame_idx in active_frame_indices:
-        
-        # determine frame boundaries
-        frame_bounds = np.array([-min_per_frame, 0]) + active_frame_idx
+    Args:
+        *restrictions: Restrictions on `FrameAnalysis.PopulationActivity` (all entries if empty).
+        seed (int, optional): Seed of the fallback selection (see `find_active_frames`). Defaults to 0.
 
-        # find frame metrics
-        start_time, end_time = np.unique(start_times[np.isin(start_times.astype("datetime64[m]"), time_vector[frame_bounds])])
-        frame_firing_rate = np.mean(population_firing_vector[frame_bounds[0]:frame_bounds[1]])
+    Returns:
+        list: `FrameAnalysis.ActiveTimeFrames` entries.
+    """
+    sessions = (FrameAnalysis.PopulationActivity * TimeFrameParamset & dj.AndList(restrictions)).fetch(as_dict=True)
 
-        # extract frame info
-        active_frames.append(
-            {
-                'frame_start': start_time,
-                'frame_end': end_time,
-                'frame_firing_rate': frame_firing_rate
-            }
+    active_frames = []
+    for session in sessions:
+        key = {k: session[k] for k in FrameAnalysis.primary_key}
+        grid_start = np.datetime64(session['grid_start'], 'm')
+        time_vector = grid_start + np.arange(len(session['smoothed_firing_vector'])) * np.timedelta64(1, 'm')
+        start_times = grid_start + session['start_time_offsets'] * np.timedelta64(1, 's')
+        active_frames.extend(
+            {**key, **active_frame}
+            for active_frame in find_active_frames(
+                start_times, time_vector, session['smoothed_firing_vector'], session['num_frames'], session['min_per_frame'], seed=seed,
+            )
         )
-    
     return active_frames
 
 """
@@ -302,24 +526,71 @@ class ImpedanceMeasurements(dj.Imported):
         """
 
     def make(self, key):
-        # fetch file path from ephysrawfile entry
-        file_path = (ephys.EphysRawFile & key).fetch1("file_path")
+        file_path, port_id = self._get_file_info(key)
+        master_entry, channel_entries = self._get_impedance_entries(key, port_id, self._read_impedance_header(file_path))
 
-        # import file
-        file = find_full_path(get_ephys_root_data_dir(), file_path)
-        try:
-            data = intanrhdreader.load_file(file)
-        except OSError:
-            raise OSError(f"OS error occurred when loading file {file.name}")
+        # insert into master
+        self.insert1(master_entry)
 
-        # extract amplifier channels
-        amplifier_channels = data['header'].pop("amplifier_channels")
+        # insert impedance data for all channels
+        with InsertBuffer(self.Channel) as channel_buffer:
+            channel_buffer.extend(channel_entries)
+
+    def populate_batch(self, *restrictions, max_workers=8):
+        """Ingest many `ImpedanceFile` entries at once.
+
+        Keys are reserved in the jobs table (as with `populate(reserve_jobs=True)`), file headers are read concurrently
+        and all entries are inserted in bulk within a single transaction. Database queries only run on the calling thread.
+
+        Args:
+            *restrictions: Restrictions applied to the key source (same as `populate`).
+            max_workers (int, optional): Number of threads reading file headers. Defaults to 8.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        jobs = schema.jobs
+        keys = ((self.key_source - self) & dj.AndList(restrictions)).fetch("KEY")
+        keys = [key for key in keys if jobs.reserve(self.table_name, key)]
+        if not keys:
+            return
+
+        try:
+            file_info = [self._get_file_info(key) for key in keys]
+
+            # only the file I/O runs in threads
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                headers = list(executor.map(self._read_impedance_header, [file_path for file_path, _ in file_info]))
+
+            entries = [
+                self._get_impedance_entries(key, port_id, header)
+                for key, (_, port_id), header in zip(keys, file_info, headers)
+            ]
+
+            with InsertBuffer(self, transaction=True, allow_direct_insert=True) as master_buffer:
+                master_buffer.extend(master_entry for master_entry, _ in entries)
+                master_buffer.flush()
+                with InsertBuffer(self.Channel) as channel_buffer:
+                    for _, channel_entries in entries:
+                        channel_buffer.extend(channel_entries)
+        except Exception as error:
+            for key in keys:
+                jobs.error(self.table_name, key, error_message=f"{type(error).__name__}: {error}")
+            raise
+        else:
+            for key in keys:
+                jobs.complete(self.table_name, key)
+
+    @staticmethod
+    def _get_file_info(key):
+        """File path and port ID of an `ImpedanceFile` entry."""
+        # fetch file path from ephysrawfile entry
+        file_path = (ephys.EphysRawFile & key).fetch1("file_path")
 
         # Figure out `Port ID` from the existing EphysSessionProbe
         port_id = set((ephys.EphysSessionProbe & key).fetch("port_id"))
 
         # Figure out `Port ID` from the existing EphysSession
-        if not (ephys.EphysSessionProbe & key):
+        if not port_id:
             raise ValueError(
                 f"No EphysSessionProbe found for the {key} - cannot determine the port ID"
             )
@@ -329,36 +600,40 @@ class ImpedanceMeasurements(dj.Imported):
             raise ValueError(
                 f"Multiple Port IDs found for the {key} - cannot determine the port ID"
             )
-        port_id = port_id.pop()
+
+        return file_path, port_id.pop()
+
+    @staticmethod
+    def _read_impedance_header(file_path):
+        """Read only the file header (impedance values are stored there, no need to decode the data block)."""
+        file = find_full_path(get_ephys_root_data_dir(), file_path)
+        try:
+            with open(file, "rb") as f:
+                return intanrhdreader.read_header(f)
+        except OSError:
+            raise OSError(f"OS error occurred when loading file {file.name}")
+
+    @staticmethod
+    def _get_impedance_entries(key, port_id, header):
+
+        # extract amplifier channels
+        amplifier_channels = header["amplifier_channels"]
 
         # get channels for the correct port
         port_channels = [channel for channel in amplifier_channels if channel['port_prefix'] == port_id]
 
-        # insert into master
-        self.insert1(
+        channel_entries = [
             {
                 **key,
-                "port_id": port_id,
+                "channel_idx": channel['custom_order'],
+                "channel_id": channel['custom_channel_name'],
+                "impedance_magnitude": channel['electrode_impedance_magnitude'],
+                "impedance_phase": channel['electrode_impedance_phase'],
             }
-        )
+            for channel in port_channels
+        ]
 
-        # loop through channels and insert impedance data
-        for channel in port_channels:
-
-            channel_idx = channel['custom_order']
-            channel_id = channel['custom_channel_name']
-            impedance_magnitude = channel['electrode_impedance_magnitude']
-            impedance_phase = channel['electrode_impedance_phase']
-
-            self.Channel.insert1(
-                {
-                    **key,
-                    "channel_idx": channel_idx,
-                    "channel_id": channel_id,
-                    "impedance_magnitude": impedance_magnitude,
-                    "impedance_phase": impedance_phase,
-                }
-            )
+        return {**key, "port_id": port_id}, channel_entries
 
 """
 analysis.Coherence
@@ -402,6 +677,33 @@ class Coherence(dj.Computed):
         synchrony: longblob  # Coherence between electrode LFP and frequency band signal
         """
 
+    class CompactConnectivity(dj.Part):
+        """
+        Pairwise coherence between all electrodes stored as a single tensor (compact alternative to Connectivity).
+        """
+        definition = """
+        -> master
+        ---
+        f: blob@datajoint-blob  # Frequency values (shared by all electrode pairs)
+        electrode_pairs: blob@datajoint-blob  # Electrode A and B of each pair (pairs x 2)
+        coherence: blob@datajoint-blob  # Coherence values for each pair (pairs x frequencies, float32)
+        """
+
+    class CompactSynchrony(dj.Part):
+        """
+        Synchrony of all electrodes and frequency bands stored as a single tensor (compact alternative to Synchrony).
+        """
+        definition = """
+        -> master
+        ---
+        f: blob@datajoint-blob  # Frequency values (shared by all electrodes and bands)
+        band_names: blob@datajoint-blob  # Frequency band of each row of synchrony
+        synchrony: blob@datajoint-blob  # Coherence between electrode LFP and frequency band signal (bands x electrodes x frequencies, float32)
+        """
+
+    # "rows": one Connectivity/Synchrony entry per electrode pair/electrode, "compact": one tensor per session, "both"
+    storage_mode = "rows"
+
     @property
     def key_source(self):
         
@@ -447,16 +749,9 @@ class Coherence(dj.Computed):
 
         # define synchronny parameters
         order = 4
-        nyquist = fs/2
 
-        # apply low pass filter to each electrode trace
-        lfp_traces = []
-        for trace in traces:
-            sos = butter(order, np.array([1, max_freq])/nyquist, btype='bandpass', output='sos')
-            filtered = sosfiltfilt(sos, trace)
-
-            lfp_traces.append(filtered)
-        lfp_traces = np.array(lfp_traces)
+        # apply band pass filter to all electrode traces (electrodes x samples)
+        lfp_traces = bandpass_filter(np.stack(traces), fs, (1, max_freq), order=order, axis=1)
 
         num_elec = lfp_traces.shape[0]
 
@@ -472,73 +767,78 @@ class Coherence(dj.Computed):
         Connectivity Analysis
         """
 
-        # loop through electrodes and find coherence between adjacent electrode pairs
-        
-        for electrode_A in range(num_elec):
-            for electrode_B in range(num_elec):
-
-                # skip duplicate electrode pairings
-                if electrode_A >= electrode_B:
-                    continue
-                
-                # get traces
-                el_A_trace = lfp_traces[electrode_A, :]
-                el_B_trace = lfp_traces[electrode_B, :]
-
-                # compute coherence
-                f, Cxy = coherence(el_A_trace, el_B_trace, fs=fs, nperseg=nperseg)
-
-                # remove frequencies greater than max_freq
-                frequencies = f[f <= max_freq]
-                connectivity = Cxy[f <= max_freq]
-
-                # insert into part table
-                self.Connectivity.insert1({
-                    **key,
-                    'electrode_a': electrode_A,
-                    'electrode_b': electrode_B,
-                    'f': frequencies,
-                    'coherence': connectivity,
-                })
+        # windowed FFT of each electrode computed once (electrodes x segments x frequencies)
+        frequencies, lfp_spectra = compute_segment_spectra(lfp_traces, fs=fs, nperseg=nperseg, max_freq=max_freq)
+
+        # find coherence between all electrode pairs from the cross-spectral density matrix
+        coherence_matrix = compute_coherence_matrix(lfp_spectra)
+
+        electrode_pairs = np.column_stack(np.triu_indices(num_elec, k=1))
+
+        if self.storage_mode in ("rows", "both"):
+            with InsertBuffer(self.Connectivity) as connectivity_buffer:
+                for electrode_A, electrode_B in electrode_pairs:
+
+                    # insert into part table
+                    connectivity_buffer.add({
+                        **key,
+                        'electrode_a': electrode_A,
+                        'electrode_b': electrode_B,
+                        'f': frequencies,
+                        'coherence': coherence_matrix[electrode_A, electrode_B],
+                    })
+
+        if self.storage_mode in ("compact", "both"):
+            self.CompactConnectivity.insert1({
+                **key,
+                'f': frequencies,
+                'electrode_pairs': electrode_pairs,
+                'coherence': coherence_matrix[electrode_pairs[:, 0], electrode_pairs[:, 1]].astype(np.float32),
+            })
         
         """
         Synchrony Analysis
         """
 
-        # loop through electrodes and find coherence between lfp signal and freq bands
-        for elec in range(num_elec):
-     
-            # get traces
-            elec_trace = lfp_traces[elec, :]
-
-            # loop through frequency bands and calculate coherence
-            for band in (analysis.SpectralBand()).fetch(as_dict=True):
-
-                # get signal of specific frequency band
-                freq_cutoff = np.array([band['lower_freq']-1, band['upper_freq']+1]) # includes 1 Hz buffer
-                if freq_cutoff[0] < 1:
-                    freq_cutoff[0] = 1
-                sos = butter(order, freq_cutoff/nyquist, btype='bandpass', output='sos')
-                filtered = sosfiltfilt(sos, elec_trace)
-
-                # get magnitude of hilbert transform (doing instead of morlet wavelets)
-                hilbert_signal = hilbert(filtered)
-                freq_power_signal = np.abs(hilbert_signal) ** 2
-
-                # find coherence between original signal and the power signal (for each frequency)
-                f, Cxy = coherence(elec_trace, freq_power_signal, fs=fs, nperseg=nperseg)
-                # remove frequencies greater than max_freq
-                frequencies = f[f <= max_freq]
-                synchrony = Cxy[f <= max_freq]
-
-                # insert into part table
-                self.Synchrony.insert1({
-                    **key,
-                    'band_name': band['band_name'],
-                    'electrode': elec,
-                    'f': frequencies,
-                    'synchrony': synchrony,
-                })
+        # loop through frequency bands and find coherence between lfp signal and freq bands (all electrodes at once)
+        band_names, band_synchrony = [], []
+        for band in (analysis.SpectralBand()).fetch(as_dict=True):
+
+            # get signal of specific frequency band
+            freq_cutoff = np.array([band['lower_freq']-1, band['upper_freq']+1]) # includes 1 Hz buffer
+            if freq_cutoff[0] < 1:
+                freq_cutoff[0] = 1
+
+            # get magnitude of hilbert transform (doing instead of morlet wavelets)
+            freq_power_signals = band_power_envelope(lfp_traces, fs, freq_cutoff, order=order, axis=1)
+
+            # find coherence between original signal and the power signal (for each frequency)
+            _, power_spectra = compute_segment_spectra(freq_power_signals, fs=fs, nperseg=nperseg, max_freq=max_freq)
+            synchrony = compute_paired_coherence(lfp_spectra, power_spectra)
+            band_names.append(band['band_name'])
+            band_synchrony.append(synchrony)
+
+        if self.storage_mode in ("rows", "both"):
+            with InsertBuffer(self.Synchrony) as synchrony_buffer:
+                for band_name, synchrony in zip(band_names, band_synchrony):
+                    for elec in range(num_elec):
+
+                        # insert into part table
+                        synchrony_buffer.add({
+                            **key,
+                            'band_name': band_name,
+                            'electrode': elec,
+                            'f': frequencies,
+                            'synchrony': synchrony[elec],
+                        })
+
+        if self.storage_mode in ("compact", "both"):
+            self.CompactSynchrony.insert1({
+                **key,
+                'f': frequencies,
+                'band_names': band_names,
+                'synchrony': np.array(band_synchrony, dtype=np.float32),
+            })
         
         # update execution duration
         self.update1(
@@ -551,6 +851,72 @@ class Coherence(dj.Computed):
             }
         )
 
+# Coherence Functions
+def compute_segment_spectra(traces, fs, nperseg, max_freq=None):
+
+    # windowed FFT of every Welch segment of each trace (rows) - same segmentation as scipy.signal.coherence defaults
+    # (hann window, 50% overlap, constant detrend)
+    traces = np.atleast_2d(traces)
+    step = nperseg - nperseg // 2
+    window = get_window('hann', nperseg)
+
+    f = sp_fft.rfftfreq(nperseg, 1 / fs)
+    freq_mask = f <= max_freq if max_freq is not None else np.ones_like(f, dtype=bool)
+
+    # one trace at a time to bound memory (segments x nperseg)
+    spectra = []
+    for trace in traces:
+        segments = np.lib.stride_tricks.sliding_window_view(trace, nperseg)[::step]
+        segments = window * (segments - segments.mean(axis=-1, keepdims=True))
+        spectra.append(sp_fft.rfft(segments, axis=-1)[:, freq_mask])
+
+    return f[freq_mask], np.array(spectra)  # (traces x segments x frequencies)
+
+def compute_coherence_matrix(spectra):
+
+    # cross-spectral density matrix for each frequency (frequencies x traces x traces)
+    spectra = np.moveaxis(spectra, -1, 0)
+    csd = np.matmul(spectra.conj(), np.swapaxes(spectra, -1, -2)) / spectra.shape[-1]
+    psd = np.real(np.diagonal(csd, axis1=-2, axis2=-1))
+
+    # magnitude-squared coherence for all pairs (traces x traces x frequencies)
+    coherence_matrix = np.abs(csd) ** 2 / psd[:, :, None] / psd[:, None, :]
+
+    return np.ascontiguousarray(np.moveaxis(coherence_matrix, 0, -1))
+
+def get_coherence_matrix(key):
+
+    # fetch the (electrodes x electrodes x frequencies) coherence cube of one Coherence entry in a single query
+    if Coherence.CompactConnectivity & key:
+        f, electrode_pairs, pair_coherence = (Coherence.CompactConnectivity & key).fetch1("f", "electrode_pairs", "coherence")
+    else:
+        query = Coherence.Connectivity & key
+        if len(Coherence & query) > 1:
+            raise ValueError(f"Multiple Coherence entries found for {key} - restrict to a single entry")
+        electrode_a, electrode_b, f, pair_coherence = query.fetch("electrode_a", "electrode_b", "f", "coherence")
+        if not len(f):
+            raise ValueError(f"No Coherence entry found for {key}")
+        f = f[0]
+        electrode_pairs = np.column_stack([electrode_a, electrode_b])
+        pair_coherence = np.stack(pair_coherence)
+
+    # fill both triangles (coherence is symmetric), a signal is fully coherent with itself
+    num_elec = electrode_pairs.max() + 1
+    coherence_matrix = np.ones((num_elec, num_elec, len(f)), dtype=pair_coherence.dtype)
+    coherence_matrix[electrode_pairs[:, 0], electrode_pairs[:, 1]] = pair_coherence
+    coherence_matrix[electrode_pairs[:, 1], electrode_pairs[:, 0]] = pair_coherence
+
+    return f, coherence_matrix
+
+def compute_paired_coherence(x_spectra, y_spectra):
+
+    # magnitude-squared coherence between each trace in x and the matching trace in y (traces x frequencies)
+    csd = np.mean(x_spectra.conj() * y_spectra, axis=1)
+    x_psd = np.mean(np.abs(x_spectra) ** 2, axis=1)
+    y_psd = np.mean(np.abs(y_spectra) ** 2, axis=1)
+
+    return np.abs(csd) ** 2 / x_psd / y_psd
+
 """
 analysis.FOOOF
 """
@@ -612,21 +978,26 @@ class FOOOFAnalysis(dj.Computed):
     r_squared: float      # R^2 of FOOOF fit
     """
 
+    spec_param_idx = 2  # spectrogram parameters used for the fit (if computed for the session)
+
     def make(self, key):
 
         # fetch electrodes to analyze
         analysis_electrodes = (FOOOFSession & key).fetch1("analysis_electrodes")
 
-        # fetch spectrogram parameters
-        spec_param_idx = (analysis.LFPSpectrogram & key).fetch("param_idx")[0]
+        # fetch spectrogram parameters (spectrograms of a single parameter set are averaged)
+        available_param_idx = set((analysis.LFPSpectrogram & key).fetch("param_idx"))
+        spec_param_idx = self.spec_param_idx if self.spec_param_idx in available_param_idx else min(available_param_idx)
+        spec_key = {"param_idx": spec_param_idx}
 
         # fetch lfp spectrograms
-        spectrograms = (analysis.LFPSpectrogram.ChannelSpectrogram & key & f"electrode IN {tuple(analysis_electrodes)}").fetch("spectrogram")
+        spectrogram_entries = analysis.fetch_spectrograms(analysis.LFPSpectrogram.ChannelSpectrogram & key & spec_key & f"electrode IN {tuple(analysis_electrodes)}")
+        spectrograms = [entry["spectrogram"] for entry in spectrogram_entries]
         spectrograms = np.stack(spectrograms, axis=-1)  # shape: (frequency, time, electrodes)
         mean_spectrum = np.mean(spectrograms, axis=(1, 2))  # shape: (frequency,)
 
         # fetch frequency vector
-        frequency = (analysis.LFPSpectrogram.ChannelSpectrogram & key & f"electrode IN {tuple(analysis_electrodes)}").fetch("frequency")[0]
+        frequency = spectrogram_entries[0]["frequency"]
 
         # fetch fooof parameters
         peak_width_limits, max_n_peaks, min_peak_height, peak_threshold, aperiodic_mode = (FOOOFParamset & key).fetch1(
@@ -745,9 +1116,17 @@ class PopulationBursts(dj.Computed):
     burst_indices: longblob # Indices of detected bursts within the time frame
     burst_peak_heights: longblob # Peak heights of detected bursts
     burst_bounds: longblob # Start and end indices of detected bursts (firing rate >= 10%% of peak height)
-    burst_spike_array: longblob # Single electrode spike array for each burst (num_bursts x num_electrodes x time_window)
+    burst_spike_array: longblob # Single electrode spike array for each burst (num_bursts x num_electrodes x time_window) - dense boolean array or sparse COO dict (see get_burst_spike_array)
     """
 
+    # store burst_spike_array as a sparse COO dict ('shape', 'coords') instead of the dense boolean array
+    sparse_spike_array = False
+
+    def populate(self, *restrictions, **kwargs):
+        # pick up corrected electrode configs (cached within a populate call)
+        clear_electrode_caches()
+        return super().populate(*restrictions, **kwargs)
+
     def make(self, key):
 
         # define parameters
@@ -766,20 +1145,22 @@ class PopulationBursts(dj.Computed):
             raise ValueError(f"Not all time windows have MUA spike data for {key} - cannot perform burst detection")
 
         # convert channel ids to electrode indices
-        electrode_ids = map_channel_to_electrode(channel_ids)
+        electrode_config_hash = get_electrode_config_hash(key['organoid_id'], key['experiment_start_time'])
+        electrode_ids = map_channel_to_electrode(channel_ids, electrode_config_hash)
 
         # get array of all spike times (relative to frame start)
         start_ms = (start_times - key['start_time']).astype('timedelta64[ms]') / np.timedelta64(1, 'ms') # ms from frame start
         rel_spike_times_ms = spike_indices / fs / (np.timedelta64(1,'ms')/np.timedelta64(1,'s')) 
         spike_times_ms = rel_spike_times_ms + start_ms
 
-        # remove electrodes outside organoid
+        # create population spike time series (1 ms bins, electrodes outside organoid removed)
         num_elec_inside = (NumElectrodesInside & f"organoid_id='{key['organoid_id']}'").fetch1('num_electrodes')
-        elec_bool = (electrode_ids < num_elec_inside)
-
-        # create population spike time series (1 ms bins)
-        time_bins = np.arange(0, np.timedelta64(key['end_time'] - key['start_time'], 'ms') / np.timedelta64(1, 'ms') + 1) # 1 ms bins
-        population_spike_series, _ = np.histogram(np.hstack(spike_times_ms[elec_bool]), bins=time_bins)
+        num_bins = int(np.timedelta64(key['end_time'] - key['start_time'], 'ms') / np.timedelta64(1, 'ms'))
+        population_spike_series = build_population_rate(
+            np.hstack([np.empty(0), *spike_times_ms]), 0, 1, num_bins,
+            electrode_ids=np.repeat(electrode_ids, [len(times) for times in spike_times_ms]),
+            num_elec_inside=num_elec_inside,
+        )
 
         # convert spike series to firing rate
         population_firing_rate = population_spike_series * 1000 # convert to spikes per second
@@ -813,43 +1194,21 @@ class PopulationBursts(dj.Computed):
         burst_indices = burst_indices[boundary_bool]
         burst_peak_heights = burst_peak_heights[boundary_bool]
 
-        # find burst windows and create spike array
-        burst_windows = []
-        burst_spike_array = np.zeros((len(burst_indices), num_elec_inside, 2*num_burst_samples), dtype=bool)
-        for burst_idx, (index, height) in enumerate(zip(burst_indices, burst_peak_heights)):
-
-            # extract burst waveform
-            waveform = population_firing_rate[index-num_burst_samples : index+num_burst_samples]
+        # find burst windows (number of indices adjacent to each burst peak over the burst threshold)
+        burst_bounds = find_burst_bounds(population_firing_rate, burst_indices, burst_bound_thresh * burst_peak_heights, num_burst_samples)
 
-            # find burst specific window threshold
-            window_thresh = burst_bound_thresh * height
-            window = np.array([0, 0])
+        # concatenate and sort the spike times of each electrode once
+        elec_spike_times = [np.sort(np.hstack([np.empty(0), *spike_times_ms[electrode_ids == elec_idx]])) for elec_idx in range(num_elec_inside)]
 
-            # find number of indices adjacent to the burst peak are over the burst threshold
-            i = 1
-            while (waveform[num_burst_samples-i] >= window_thresh) & (num_burst_samples-i > 0): # make sure it doesn't exceed the number of extracted samples
-                window[0] -= 1 # indices before burst peak
-                i += 1
-            i = 1
-            while (waveform[num_burst_samples+i] >= window_thresh) & (num_burst_samples+i < len(waveform)-1):
-                window[1] += 1 # indices after burst peak
-                i += 1        
-            
-            burst_windows.append(window)
+        # find spikes within each burst window -> (burst, electrode, sample) coordinates
+        burst_spike_coords = extract_burst_spike_coords(elec_spike_times, burst_indices - num_burst_samples, 2*num_burst_samples)
+        burst_spike_shape = (len(burst_indices), num_elec_inside, 2*num_burst_samples)
 
-            # fill in spike array for each electrode
-            for elec_idx in range(num_elec_inside):
-
-                # get spike times for electrode
-                elec_spike_times = np.hstack(spike_times_ms[electrode_ids == elec_idx])
-
-                # find spikes within burst window
-                burst_spike_times = elec_spike_times[((index-num_burst_samples) <= elec_spike_times) & (elec_spike_times <= (index+num_burst_samples))]
-
-                # convert to indices within burst spike array
-                burst_spike_indices = (burst_spike_times - (index-num_burst_samples)).astype(int)
-                burst_spike_array[burst_idx, elec_idx, burst_spike_indices] = True
-        burst_bounds = np.array(burst_windows)
+        if self.sparse_spike_array:
+            burst_spike_array = {'shape': burst_spike_shape, 'coords': burst_spike_coords.astype(np.int32)}
+        else:
+            burst_spike_array = np.zeros(burst_spike_shape, dtype=bool)
+            burst_spike_array[tuple(burst_spike_coords)] = True
 
         # insert into table
         self.insert1({
@@ -858,4 +1217,51 @@ class PopulationBursts(dj.Computed):
             'burst_peak_heights': burst_peak_heights,
             'burst_bounds': burst_bounds,
             'burst_spike_array': burst_spike_array,
-        })
\ No newline at end of file
+        })
+
+def find_burst_bounds(firing_rate, burst_indices, thresholds, num_burst_samples):
+
+    # extract all burst waveforms at once (num_bursts x 2*num_burst_samples), burst peak at num_burst_samples
+    waveforms = firing_rate[np.asarray(burst_indices)[:, None] + np.arange(-num_burst_samples, num_burst_samples)]
+    over_thresh = waveforms >= np.asarray(thresholds)[:, None]
+
+    # walk outward from the peak until the firing rate drops below the threshold (without exceeding the extracted samples)
+    before_peak = over_thresh[:, num_burst_samples-1:0:-1]
+    after_peak = over_thresh[:, num_burst_samples+1:-1]
+
+    def _count_leading(over):
+        return np.where(over.all(axis=1), over.shape[1], np.argmin(over, axis=1))
+
+    # start and end indices relative to the burst peak (num_bursts x 2)
+    return np.column_stack([-_count_leading(before_peak), _count_leading(after_peak)])
+
+def extract_burst_spike_coords(elec_spike_times, window_starts, window_len):
+
+    # locate the spikes of each burst window with a binary search on the sorted spike times of each electrode
+    window_starts = np.asarray(window_starts)
+    coords = [np.empty((3, 0), dtype=int)]
+    for elec_idx, spike_times in enumerate(elec_spike_times):
+        first = np.searchsorted(spike_times, window_starts, side='left')
+        last = np.searchsorted(spike_times, window_starts + window_len, side='left')
+        counts = last - first
+
+        # spike positions of all windows, concatenated
+        burst_ids = np.repeat(np.arange(len(window_starts)), counts)
+        spike_idx = np.arange(counts.sum()) + np.repeat(first - np.cumsum(counts) + counts, counts)
+
+        # convert to indices within burst spike array
+        samples = (spike_times[spike_idx] - window_starts[burst_ids]).astype(int)
+        coords.append(np.vstack([burst_ids, np.full_like(burst_ids, elec_idx), samples]))
+
+    # (3 x num_spikes) burst, electrode and sample indices - multiple spikes in one sample are counted once
+    return np.unique(np.hstack(coords), axis=1)
+
+def get_burst_spike_array(key):
+
+    # dense (num_bursts x num_electrodes x time_window) spike array of a PopulationBursts entry, regardless of storage format
+    burst_spike_array = (PopulationBursts & key).fetch1('burst_spike_array')
+    if isinstance(burst_spike_array, dict):
+        dense_array = np.zeros(tuple(burst_spike_array['shape']), dtype=bool)
+        dense_array[tuple(burst_spike_array['coords'])] = True
+        return dense_array
+    return burst_spike_array
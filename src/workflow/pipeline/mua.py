@@ -1,4 +1,5 @@
 import tempfile
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -8,14 +9,44 @@ import numpy as np
 import scipy.stats
 import spikeinterface as si
 from element_interface.utils import find_full_path
-from scipy.signal import find_peaks
 
-from workflow import DB_PREFIX
+from workflow import DB_PREFIX, PRECOMPUTE_PLOTS
 from workflow.pipeline import culture, ephys
+from workflow.utils.insert_buffer import InsertBuffer
+from workflow.utils.signal_utils import (
+    detect_spikes,
+    minmax_decimate_indices,
+    snippet_summary,
+)
+from workflow.utils.trace_cache import TraceCache
 
 schema = dj.schema(DB_PREFIX + "mua")
 
 
+# preprocessing applied to the MUA traces (also part of the trace cache address)
+MUA_PREPROCESSING = {"freq_min": 300, "freq_max": 6000, "operator": "median"}
+
+
+@schema
+class EphysRawFileHeader(dj.Imported):
+    definition = """ # Header metadata of each raw ephys file (read once at ingestion)
+    -> ephys.EphysRawFile
+    ---
+    sampling_rate: float  # amplifier sampling rate in Hz
+    num_samples: int  # number of amplifier samples per channel
+    dtype: varchar(16)  # amplifier data type
+    stream_name: varchar(64)  # amplifier stream name
+    channel_ids: longblob  # amplifier channel ids
+    port_prefixes: longblob  # port prefix of each amplifier channel
+    """
+
+    def make(self, key):
+        file_path, acq_software = (ephys.EphysRawFile & key).fetch1(
+            "file_path", "acq_software"
+        )
+        self.insert1({**key, **_read_file_header(file_path, acq_software)})
+
+
 @schema
 class MUAEphysSession(dj.Computed):
     definition = """
@@ -107,32 +138,30 @@ class MUASpikes(dj.Computed):
 
     threshold_uV = 50  # 50 uV
     peak_sign = "both"
+    chunk_duration = (
+        60  # seconds - longer sessions are streamed in chunks of this duration
+    )
+    # write the preprocessed traces to the trace cache (only read when plots are precomputed by MUATracePlot)
+    cache_traces = PRECOMPUTE_PLOTS
 
     def make(self, key):
 
         execution_time = datetime.now(timezone.utc)
 
-        start_time, end_time = (MUAEphysSession & key).fetch1("start_time", "end_time")
+        si_recording = _get_preprocessed_recording(key)
 
-        port_id = (MUAEphysSession & key).fetch1("port_id")
-        parent_folder = (culture.ExperimentDirectory & key).fetch1(
-            "experiment_directory"
-        )
-
-        si_recording = _get_si_recording(start_time, end_time, parent_folder, port_id)
-
-        # Preprocess the recording
-        si_recording = si.preprocessing.bandpass_filter(
-            recording=si_recording, freq_min=300, freq_max=6000
-        )
-        si_recording = si.preprocessing.common_reference(
-            recording=si_recording, operator="median"
+        # preprocessed traces are cached for downstream tables (e.g. MUATracePlot)
+        trace_cache = TraceCache()
+        write_cache = self.cache_traces and trace_cache.enabled
+        cache_key = _get_trace_cache_key(key)
+        cache_metadata = dict(
+            fs=si_recording.get_sampling_frequency(),
+            channel_ids=list(si_recording.channel_ids),
         )
 
         fs = si_recording.get_sampling_frequency()
         duration = si_recording.get_duration()
         refractory_period = 0.002  # 2 ms
-        refractory_samples = int(refractory_period * fs)
 
         peak_sign = self.peak_sign
 
@@ -148,42 +177,53 @@ class MUASpikes(dj.Computed):
 
         key["threshold_uv"] = self.threshold_uV
 
-        for ch_idx, ch_id in enumerate(si_recording.channel_ids):
-            # channel trace in uV
-            trace = np.squeeze(
-                si_recording.get_traces(channel_ids=[ch_id], return_in_uV=True)
+        if duration <= self.chunk_duration:
+            # all port channels in uV (samples x channels) - preprocess once for the session
+            traces = si_recording.get_traces(return_in_uV=True)
+            if write_cache:
+                trace_cache.put(cache_key, traces, **cache_metadata)
+
+            noise_levels, spike_indices, spike_amps = detect_spikes(
+                traces,
+                fs,
+                threshold_uV=self.threshold_uV,
+                peak_sign=peak_sign,
+                refractory_period=refractory_period,
             )
-            # median absolute deviation
-            noise_level = scipy.stats.median_abs_deviation(trace, scale="normal")
-            # spike detection
-            threshold_uV = max(self.threshold_uV, 5 * noise_level)
-            if peak_sign == "neg":
-                spk_ind, spk_amp = find_peaks(
-                    -trace, height=threshold_uV, distance=refractory_samples
-                )
-                spk_amp = -spk_amp["peak_heights"]
-            elif peak_sign == "both":
-                spk_ind, spk_amp = find_peaks(
-                    np.abs(trace), height=threshold_uV, distance=refractory_samples
+        else:
+            with (
+                trace_cache.open_writer(
+                    cache_key,
+                    (si_recording.get_num_samples(), si_recording.get_num_channels()),
+                    **cache_metadata,
                 )
-                spk_amp = trace[spk_ind]
-            else:
-                spk_ind, spk_amp = find_peaks(
-                    trace, height=threshold_uV, distance=refractory_samples
+                if write_cache
+                else nullcontext()
+            ) as cached_traces:
+                noise_levels, spike_indices, spike_amps = _detect_spikes_chunked(
+                    si_recording,
+                    threshold_uV=self.threshold_uV,
+                    peak_sign=peak_sign,
+                    refractory_period=refractory_period,
+                    chunk_duration=self.chunk_duration,
+                    out=cached_traces,
                 )
 
-            self.Channel.insert1(
-                dict(
-                    **key,
-                    channel_idx=ch_idx,
-                    channel_id=ch_id,
-                    spike_count=len(spk_ind),
-                    spike_rate=len(spk_ind) / duration,
-                    noise_level=noise_level,
-                    spike_indices=spk_ind,
-                    spike_amp=spk_amp,
+        with InsertBuffer(self.Channel) as channel_buffer:
+            for ch_idx, ch_id in enumerate(si_recording.channel_ids):
+                spk_ind = spike_indices[ch_idx]
+                channel_buffer.add(
+                    dict(
+                        **key,
+                        channel_idx=ch_idx,
+                        channel_id=ch_id,
+                        spike_count=len(spk_ind),
+                        spike_rate=len(spk_ind) / duration,
+                        noise_level=noise_levels[ch_idx],
+                        spike_indices=spk_ind,
+                        spike_amp=spike_amps[ch_idx],
+                    )
                 )
-            )
 
         self.update1(
             {
@@ -217,6 +257,7 @@ class MUATracePlot(dj.Computed):
         """
 
     spike_rate_threshold = 100.0  # Hz, temporarily set high for testing/validation (default was 0.5 Hz)
+    max_trace_points = 20000  # max number of points in the trace plot (min/max envelope), None to plot the full trace
 
     key_source = (
         MUASpikes
@@ -227,23 +268,9 @@ class MUATracePlot(dj.Computed):
     def make(self, key):
         execution_time = datetime.now(timezone.utc)
 
-        start_time, end_time = (MUAEphysSession & key).fetch1("start_time", "end_time")
-        port_id = (MUAEphysSession & key).fetch1("port_id")
-        parent_folder = (culture.ExperimentDirectory & key).fetch1(
-            "experiment_directory"
-        )
-        si_recording = _get_si_recording(start_time, end_time, parent_folder, port_id)
-
-        # Preprocess the recording
-        si_recording = si.preprocessing.bandpass_filter(
-            recording=si_recording, freq_min=300, freq_max=6000
-        )
-        si_recording = si.preprocessing.common_reference(
-            recording=si_recording, operator="median"
-        )
+        traces, fs, channel_ids = get_preprocessed_traces(key)
 
-        fs = si_recording.get_sampling_frequency()
-        times = si_recording.get_times()
+        times = np.arange(traces.shape[0]) / fs
         title = f"{key['organoid_id']} | {key['start_time']}"
         spk_rate_thres = self.spike_rate_threshold
 
@@ -258,51 +285,68 @@ class MUATracePlot(dj.Computed):
         tmp_dir = tempfile.TemporaryDirectory()
         peak_sign = (MUASpikes & key).fetch1("peak_sign")
         chn_query = MUASpikes.Channel & key & f"spike_rate >= {spk_rate_thres}"
-        for chn_data in chn_query.fetch(as_dict=True):
-            ch_id = si_recording.channel_ids[chn_data["channel_idx"]]
-            trace = np.squeeze(
-                si_recording.get_traces(channel_ids=[ch_id], return_in_uV=True)
-            )
-            spk_ind = chn_data["spike_indices"]
-
-            if peak_sign == "both":
-                # get the "neg" peaks only
-                spk_ind = spk_ind[np.where(chn_data["spike_amp"] < 0)[0]]
-
-            title_ = title + f" | ChnID: {ch_id}"
-            # waveform plot
-            # compute average waveform - 2ms before and after the spike
-            pad_len = int(2e-3 * fs)
-            wfs = []
-            for idx in spk_ind:
-                if idx - pad_len >= 0 and idx + pad_len < len(trace):
-                    wfs.append(trace[idx - pad_len : idx + pad_len])
-
-            if len(wfs) > 0:
-                mean_wf = np.mean(np.vstack(wfs), axis=0)
-            else:
-                mean_wf = np.array([])
-
-            wf_fig = _plot_mean_waveform(mean_wf, fs, title_)
-
-            # format a string into a filename compatible string
-            filename = title_.replace(" ", "").replace(":", "-").replace("|", "-")
-            filepath = Path(tmp_dir.name) / f"{filename}_waveform.png"
-            wf_fig.savefig(filepath)
-
-            trace_fig = _plot_trace_with_peaks(
-                trace, times, spk_ind, f"ch_{ch_id}", title_
-            )
+        chn_entries = chn_query.fetch(as_dict=True)
 
-            self.Channel.insert1(
-                {
-                    **key,
-                    "channel_idx": chn_data["channel_idx"],
-                    "trace_plot": trace_fig.to_json(),
-                    "mean_waveform": mean_wf,
-                    "waveform_plot": filepath,
-                }
-            )
+        spike_indices = [
+            get_plot_spike_indices(chn_data, peak_sign) for chn_data in chn_entries
+        ]
+
+        # compute average waveforms of all channels - 2ms before and after the spike
+        pad_len = int(2e-3 * fs)
+        waveforms = snippet_summary(
+            traces[:, [chn_data["channel_idx"] for chn_data in chn_entries]],
+            spike_indices,
+            pad_len,
+            pad_len,
+        )
+
+        # trace plots are large - keep only a few of them in memory at a time
+        with InsertBuffer(self.Channel, batch_size=4) as channel_buffer:
+            for i, chn_data in enumerate(chn_entries):
+                ch_id = channel_ids[chn_data["channel_idx"]]
+                trace = np.asarray(traces[:, chn_data["channel_idx"]])
+                spk_ind = spike_indices[i]
+
+                title_ = title + f" | ChnID: {ch_id}"
+                # waveform plot
+                if waveforms["count"][i] > 0:
+                    mean_wf = waveforms["mean"][i]
+                else:
+                    mean_wf = np.array([])
+
+                wf_fig = plot_mean_waveform(mean_wf, fs, title_)
+
+                # format a string into a filename compatible string
+                filename = title_.replace(" ", "").replace(":", "-").replace("|", "-")
+                filepath = Path(tmp_dir.name) / f"{filename}_waveform.png"
+                wf_fig.savefig(filepath)
+
+                # decimate the trace plot, keeping the spikes on the trace
+                plot_indices = (
+                    minmax_decimate_indices(
+                        trace, self.max_trace_points, keep_indices=spk_ind
+                    )
+                    if self.max_trace_points
+                    else None
+                )
+                trace_fig = plot_trace_with_peaks(
+                    trace,
+                    times,
+                    spk_ind,
+                    f"ch_{ch_id}",
+                    title_,
+                    plot_indices=plot_indices,
+                )
+
+                channel_buffer.add(
+                    {
+                        **key,
+                        "channel_idx": chn_data["channel_idx"],
+                        "trace_plot": trace_fig.to_json(),
+                        "mean_waveform": mean_wf,
+                        "waveform_plot": filepath,
+                    }
+                )
 
         self.update1(
             {
@@ -319,12 +363,77 @@ class MUATracePlot(dj.Computed):
         plt.clf()
 
 
+def _get_preprocessed_recording(key):
+    """
+    Get the MUA-preprocessed (bandpass filtered and common referenced) SI recording of an `MUAEphysSession`.
+    """
+    start_time, end_time = (MUAEphysSession & key).fetch1("start_time", "end_time")
+    port_id = (MUAEphysSession & key).fetch1("port_id")
+    parent_folder = (culture.ExperimentDirectory & key).fetch1("experiment_directory")
+
+    si_recording = _get_si_recording(start_time, end_time, parent_folder, port_id)
+
+    # Preprocess the recording
+    si_recording = si.preprocessing.bandpass_filter(
+        recording=si_recording,
+        freq_min=MUA_PREPROCESSING["freq_min"],
+        freq_max=MUA_PREPROCESSING["freq_max"],
+    )
+    si_recording = si.preprocessing.common_reference(
+        recording=si_recording, operator=MUA_PREPROCESSING["operator"]
+    )
+    return si_recording
+
+
+def get_preprocessed_traces(key):
+    """
+    Get the MUA-preprocessed traces (samples x channels, in uV) of an `MUAEphysSession`.
+    The traces cached by `MUASpikes` are mapped, or preprocessed again if they were evicted.
+
+    Returns:
+        traces: (samples x channels) traces in uV
+        fs: sampling frequency in Hz
+        channel_ids: channel ids
+    """
+    trace_cache = TraceCache()
+    cache_key = _get_trace_cache_key(key)
+    cached = trace_cache.get(cache_key)
+    if cached is None:
+        si_recording = _get_preprocessed_recording(key)
+        traces = si_recording.get_traces(return_in_uV=True)
+        fs = si_recording.get_sampling_frequency()
+        channel_ids = si_recording.channel_ids
+        trace_cache.put(cache_key, traces, fs=fs, channel_ids=list(channel_ids))
+    else:
+        traces, cache_metadata = cached
+        fs = cache_metadata["fs"]
+        channel_ids = np.array(cache_metadata["channel_ids"])
+    return traces, fs, channel_ids
+
+
+def get_plot_spike_indices(chn_data, peak_sign):
+    """
+    Spike indices of a `MUASpikes.Channel` entry shown in plots (only the "neg" peaks if `peak_sign` is "both").
+    """
+    spk_ind = chn_data["spike_indices"]
+    if peak_sign == "both":
+        # get the "neg" peaks only
+        spk_ind = spk_ind[np.where(chn_data["spike_amp"] < 0)[0]]
+    return spk_ind
+
+
+def _get_trace_cache_key(key):
+    """
+    Trace cache address of the MUA-preprocessed traces of an `MUAEphysSession`.
+    """
+    session_key = (MUAEphysSession & key).fetch1("KEY")
+    return TraceCache.get_cache_key(session_key, MUA_PREPROCESSING)
+
+
 def _get_si_recording(start_time, end_time, parent_folder, port_id):
     """
     Get the spikeinterface recording object for the given time range.
     """
-    import intanrhdreader
-
     files, file_times, acq_softwares = (
         ephys.EphysRawFile
         & {"parent_folder": parent_folder}
@@ -339,18 +448,35 @@ def _get_si_recording(start_time, end_time, parent_folder, port_id):
 
     acq_software = acq_softwares[0]
 
-    # read intan header
-    with open(find_full_path(ephys.get_ephys_root_data_dir(), files[0]), "rb") as f:
-        header = intanrhdreader.read_header(f)
-    port_indices = np.array(
-        [
-            ind
-            for ind, ch in enumerate(header["amplifier_channels"])
-            if ch["port_prefix"] == port_id
-        ]
+    # read file headers from the index (None for raw files not yet indexed)
+    headers = _get_file_headers(files)
+
+    # open the file extractors (only files that are not indexed yet are probed for their stream)
+    si_recordings, stream_names = _open_si_extractors(
+        files,
+        acq_software,
+        stream_names=[header and header["stream_name"] for header in headers],
+    )
+
+    # complete the headers of new files from the extractors opened above
+    headers = [
+        header or _read_file_header(f, acq_software, rec, stream_name)
+        for f, header, rec, stream_name in zip(
+            files, headers, si_recordings, stream_names
+        )
+    ]
+    _check_contiguity(files, file_times, headers)
+
+    port_indices = np.flatnonzero(
+        np.asarray(headers[0]["port_prefixes"]) == port_id
     )  # get the row indices of the port
 
-    si_recording = _build_si_recording_object(files, acq_software)
+    # Concatenate all files at once into a single flat recording
+    si_recording = (
+        si_recordings[0]
+        if len(si_recordings) == 1
+        else si.concatenate_recordings(si_recordings)
+    )
 
     si_recording = si_recording.select_channels(
         si_recording.channel_ids[port_indices]
@@ -364,62 +490,261 @@ def _get_si_recording(start_time, end_time, parent_folder, port_id):
     return si_recording
 
 
-def _build_si_recording_object(files, acq_software="intan"):
+def _get_file_headers(files):
+    """
+    Get the header metadata of the given files from `EphysRawFileHeader`.
+    Args:
+        files: list of file paths (relative to the ephys root data directory)
+
+    Returns:
+        headers: list of header dicts in the order of `files` (None for files that are not indexed yet)
+    """
+    indexed = {
+        header["file_path"]: header
+        for header in (EphysRawFileHeader & [{"file_path": f} for f in files]).fetch(
+            as_dict=True
+        )
+    }
+    return [indexed.get(f) for f in files]
+
+
+def _read_file_header(
+    file_path, acq_software="intan", si_recording=None, stream_name=None
+):
+    """
+    Read the header metadata of a raw ephys file.
+    Only the Intan header bytes are parsed; the remaining metadata is taken from `si_recording`
+    (opened if not given).
+    Args:
+        file_path: file path (relative to the ephys root data directory)
+        acq_software: acquisition software name
+        si_recording: SI extractor of the file (see `_open_si_extractors`)
+        stream_name: amplifier stream name of `si_recording`
+
+    Returns:
+        header: dict with the attributes of `EphysRawFileHeader`
+    """
+    import intanrhdreader
+
+    if si_recording is None:
+        (si_recording,), (stream_name,) = _open_si_extractors([file_path], acq_software)
+
+    # read intan header (port prefixes)
+    full_path = find_full_path(ephys.get_ephys_root_data_dir(), file_path)
+    with open(full_path, "rb") as f:
+        header = intanrhdreader.read_header(f)
+
+    return {
+        "file_path": file_path,
+        "sampling_rate": si_recording.get_sampling_frequency(),
+        "num_samples": si_recording.get_num_samples(),
+        "dtype": str(si_recording.get_dtype()),
+        "stream_name": stream_name,
+        "channel_ids": np.asarray(si_recording.channel_ids),
+        "port_prefixes": np.array(
+            [ch["port_prefix"] for ch in header["amplifier_channels"]]
+        ),
+    }
+
+
+def _check_contiguity(files, file_times, headers, tolerance=timedelta(seconds=1)):
+    """
+    Raise an error if consecutive files are not contiguous in time, i.e. a file does not start where the previous one ends
+    (concatenating them would shift all subsequent spike times).
+    Args:
+        files: list of file paths, sorted by file time
+        file_times: list of file start times (`EphysRawFile.file_time`)
+        headers: list of header dicts (see `_read_file_header`)
+        tolerance: allowed mismatch (file times have a resolution of one second)
+    """
+    for i in range(1, len(files)):
+        expected_time = file_times[i - 1] + timedelta(
+            seconds=headers[i - 1]["num_samples"] / headers[i - 1]["sampling_rate"]
+        )
+        gap = file_times[i] - expected_time
+        if abs(gap) > tolerance:
+            raise ValueError(
+                f"Non-contiguous ephys files: {files[i]} starts {gap.total_seconds():.1f} s "
+                f"after the end of {files[i - 1]}"
+            )
+
+
+def _open_si_extractors(files, acq_software="intan", stream_names=None, max_workers=8):
     """
-    Build the spikeinterface recording object from the given files.
+    Open the spikeinterface extractor of each file.
     Args:
-        files: list of file full paths
+        files: list of file paths (relative to the ephys root data directory)
         acq_software: acquisition software name
+        stream_names: list of amplifier stream names for each file (None entries are read from the files)
+        max_workers: number of threads opening the file extractors
 
     Returns:
-        si_recording: SI recording object
+        si_recordings: list of SI recording objects, in the order of `files`
+        stream_names: list of amplifier stream names
     """
+    from concurrent.futures import ThreadPoolExecutor
 
     from spikeinterface.extractors.extractor_classes import (
         recording_extractor_full_dict,
     )
 
-    si_recording = None
+    if not len(files):
+        raise ValueError("No ephys files to open")
 
     si_extractor = recording_extractor_full_dict[acq_software.replace(" ", "").lower()]
 
-    # Read data. Concatenate if multiple files are found.
-    for file_path in (
-        find_full_path(ephys.get_ephys_root_data_dir(), f) for f in files
-    ):
-        # Get stream name for this file
-        streams = si_extractor.get_streams(file_path)[0]
-        amplifier_streams = [s for s in streams if "amplifier" in s]
+    if stream_names is None:
+        stream_names = [None] * len(files)
 
-        if not amplifier_streams:
-            raise ValueError(f"No amplifier stream found in file: {file_path}")
+    def _open_extractor(file_path, stream_name):
+        file_path = find_full_path(ephys.get_ephys_root_data_dir(), file_path)
 
-        stream_name = amplifier_streams[0]
+        if stream_name is None:
+            # Get stream name for this file
+            streams = si_extractor.get_streams(file_path)[0]
+            amplifier_streams = [s for s in streams if "amplifier" in s]
 
-        if not si_recording:
-            si_recording = si_extractor(file_path, stream_name=stream_name)
-        else:
-            si_recording = si.concatenate_recordings(
-                [
-                    si_recording,
-                    si_extractor(file_path, stream_name=stream_name),
-                ]
-            )
+            if not amplifier_streams:
+                raise ValueError(f"No amplifier stream found in file: {file_path}")
 
-    return si_recording
+            stream_name = amplifier_streams[0]
 
+        return si_extractor(file_path, stream_name=stream_name), stream_name
 
-def _plot_trace_with_peaks(
-    trace, times, peak_indices, trace_name="trace", title="Spike Detection"
+    # Read data (files are opened in parallel, order is preserved)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        si_recordings, stream_names = zip(
+            *executor.map(_open_extractor, files, stream_names)
+        )
+
+    return list(si_recordings), list(stream_names)
+
+
+def _detect_spikes_chunked(
+    si_recording,
+    threshold_uV,
+    peak_sign="both",
+    refractory_period=0.002,
+    chunk_duration=60,
+    out=None,
 ):
+    """
+    Stream the recording in chunks of `chunk_duration` seconds and detect spikes with `detect_spikes`,
+    keeping peak memory constant regardless of the session length.
+
+    The first pass estimates the noise level of each channel as the median of the per-chunk MADs,
+    the second pass detects spikes with those fixed thresholds. Each chunk is read with a margin of
+    several refractory periods on both sides so that peaks and the refractory criterion near chunk
+    edges are resolved as in a single block; filter edge effects are handled by the margins
+    spikeinterface applies in `get_traces`.
+
+    Args:
+        si_recording: preprocessed SI recording object
+        threshold_uV: minimum detection threshold in uV
+        peak_sign: "neg", "pos" or "both"
+        refractory_period: minimum distance between spikes in seconds
+        chunk_duration: chunk duration in seconds
+        out: optional (samples x channels) array the preprocessed traces are written into (e.g. a trace cache entry)
+
+    Returns:
+        noise_levels: (channels,) noise level estimate of each channel
+        spike_indices: list of spike indices in samples, one array per channel
+        spike_amps: list of spike amplitudes in uV, one array per channel
+    """
+    fs = si_recording.get_sampling_frequency()
+    num_samples = si_recording.get_num_samples()
+    chunk_size = int(chunk_duration * fs)
+    margin = 10 * max(int(refractory_period * fs), 1)
+    chunk_starts = np.arange(0, num_samples, chunk_size)
+
+    # first pass - noise level
+    chunk_noise_levels = [
+        scipy.stats.median_abs_deviation(
+            si_recording.get_traces(
+                start_frame=start,
+                end_frame=min(start + chunk_size, num_samples),
+                return_in_uV=True,
+            ),
+            axis=0,
+            scale="normal",
+        )
+        for start in chunk_starts
+    ]
+    noise_levels = np.median(chunk_noise_levels, axis=0)
+
+    # second pass - spike detection
+    spike_indices, spike_amps = [], []
+    for start in chunk_starts:
+        end = min(start + chunk_size, num_samples)
+        read_start, read_end = max(start - margin, 0), min(end + margin, num_samples)
+        traces = si_recording.get_traces(
+            start_frame=read_start, end_frame=read_end, return_in_uV=True
+        )
+        if out is not None:
+            out[start:end] = traces[start - read_start : end - read_start]
+        _, chunk_indices, chunk_amps = detect_spikes(
+            traces,
+            fs,
+            threshold_uV=threshold_uV,
+            peak_sign=peak_sign,
+            refractory_period=refractory_period,
+            noise_levels=noise_levels,
+        )
+        # only keep peaks within the chunk itself - margins belong to the neighbouring chunks
+        chunk_indices = [spk_ind + read_start for spk_ind in chunk_indices]
+        in_chunk = [(spk_ind >= start) & (spk_ind < end) for spk_ind in chunk_indices]
+        spike_indices.append(
+            [spk_ind[keep] for spk_ind, keep in zip(chunk_indices, in_chunk)]
+        )
+        spike_amps.append(
+            [spk_amp[keep] for spk_amp, keep in zip(chunk_amps, in_chunk)]
+        )
+
+    spike_indices = [np.concatenate(ch_indices) for ch_indices in zip(*spike_indices)]
+    spike_amps = [np.concatenate(ch_amps) for ch_amps in zip(*spike_amps)]
+
+    return noise_levels, spike_indices, spike_amps
+
+
+def plot_trace_with_peaks(
+    trace,
+    times,
+    peak_indices,
+    trace_name="trace",
+    title="Spike Detection",
+    plot_indices=None,
+):
+    """
+    Plotly figure of the trace with the detected peaks.
+    Args:
+        trace: (samples,) trace in uV
+        times: (samples,) times in seconds
+        peak_indices: sample indices of the peaks
+        trace_name: legend name of the trace
+        title: figure title
+        plot_indices: sample indices of the trace to plot (e.g. from `minmax_decimate_indices`), all samples if None
+
+    Returns:
+        fig: plotly figure (amplitudes stored as float32 to keep the JSON compact)
+    """
     from plotly import graph_objects as go
 
+    if plot_indices is None:
+        plot_indices = slice(None)
+
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=times, y=trace, mode="lines", name=trace_name))
+    fig.add_trace(
+        go.Scatter(
+            x=times[plot_indices],
+            y=trace[plot_indices].astype(np.float32),
+            mode="lines",
+            name=trace_name,
+        )
+    )
     fig.add_trace(
         go.Scatter(
             x=times[peak_indices],
-            y=trace[peak_indices],
+            y=trace[peak_indices].astype(np.float32),
             mode="markers",
             marker=dict(color="red"),
             name="spike",
@@ -435,7 +760,7 @@ def _plot_trace_with_peaks(
     return fig
 
 
-def _plot_mean_waveform(mean_wf, fs, title="Mean Waveform"):
+def plot_mean_waveform(mean_wf, fs, title="Mean Waveform"):
     times = np.arange(-len(mean_wf) / 2, len(mean_wf) / 2) / fs
     times *= 1e3  # times in ms
     fig, ax = plt.subplots()
@@ -1,13 +1,14 @@
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 
 import datajoint as dj
-import matplotlib.pyplot as plt
 import numpy as np
 
 from workflow import DB_PREFIX
 from workflow.pipeline import analysis, ephys, ephys_sorter
+from workflow.utils.insert_buffer import InsertBuffer
 
 logger = dj.logger
 schema = dj.schema(DB_PREFIX + "report")
@@ -60,6 +61,17 @@ class SpectrogramAndPowerPlots(dj.Computed):
         band_power_plot: attach   # Normalized band power plot image
         """
 
+    # Session level - the plots of all electrodes of a session are rendered in one job
+    # (high-gamma windowing params only, default for automated population)
+    key_source = (
+        ephys.LFP * analysis.SpectrogramParameters & "param_idx=2"
+    ) & analysis.LFPSpectrogram
+
+    # rendering options
+    max_workers = 4  # number of processes rendering plots (1 to render serially)
+    plot_dpi = 100
+    plot_format = "png"  # "png" or "webp" (smaller files, requires Pillow)
+
     def make(self, key):
         execution_start = datetime.now(timezone.utc)
 
@@ -67,140 +79,218 @@ class SpectrogramAndPowerPlots(dj.Computed):
         freq_min = analysis.SpectralBand.fetch("lower_freq").min()
         freq_max = analysis.SpectralBand.fetch("upper_freq").max()
 
-        # Insert main entry
-        self.insert1(
-            {**key, "freq_min": freq_min, "freq_max": freq_max, "execution_duration": 0}
-        )
-
         # Create temporary directory for plots
         with tempfile.TemporaryDirectory() as tmpdir:
             tmp_path = Path(tmpdir)
 
-            # Fetch all spectrograms for this recording
-            spectrograms = (analysis.LFPSpectrogram.ChannelSpectrogram & key).fetch(
-                as_dict=True
+            plot_jobs = get_channel_plot_jobs(
+                key, tmp_path, dpi=self.plot_dpi, fmt=self.plot_format
             )
-            bands = analysis.SpectralBand.fetch(as_dict=True)
-
-            # Color scheme for frequency bands
-            lfp_colors = [
-                "#ad2bea",
-                "#4d3ff8",
-                "#39cabb",
-                "#53e53a",
-                "#e3e12c",
-                "#f7a740",
-                "#ed3838",
-            ]
-
-            # Process each electrode separately
-            for ch_data in spectrograms:
-                electrode = ch_data["electrode"]
-                Sxx, t, f = (
-                    ch_data["spectrogram"],
-                    ch_data["time"],
-                    ch_data["frequency"],
-                )
-                freq_mask = (f >= freq_min) & (f <= freq_max)
-
-                # Spectrogram plot
-                spectrogram_fig, ax = plt.subplots(figsize=(12, 8))
-                im = ax.pcolormesh(
-                    t, f[freq_mask], np.log10(Sxx[freq_mask, :]), shading="auto"
-                )
-                spectrogram_fig.colorbar(im, ax=ax, label="log Power (μV²/Hz)")
-                ax.set_xlabel("Time (s)")
-                ax.set_ylabel("Frequency (Hz)")
-                ax.set_title(
-                    f"Spectrogram\nOrganoid {key['organoid_id']} | {key['start_time']} - {key['end_time']}\nCh {electrode}"
-                )
-
-                # Highlight frequency bands
-                for i, band in enumerate(bands):
-                    color = lfp_colors[i % len(lfp_colors)]
-                    ax.axhspan(
-                        band["lower_freq"], band["upper_freq"], alpha=0.15, color=color
-                    )
-                    ax.text(
-                        -0.05,
-                        (band["lower_freq"] + band["upper_freq"]) / 2,
-                        band["band_name"],
-                        va="center",
-                        ha="right",
-                        transform=ax.get_yaxis_transform(),
-                        color="navy",
-                        fontsize=9,
-                    )
 
-                # Save spectrogram plot
-                filename_spectrogram = f"organoid_{key['organoid_id']}_ch{electrode}_{key['start_time']}_{key['end_time']}_spectrogram.png"
-                filepath_spectrogram = tmp_path / filename_spectrogram
-                spectrogram_fig.savefig(
-                    filepath_spectrogram, bbox_inches="tight", dpi=100
-                )
-                plt.close(spectrogram_fig)
-
-                # Band Power Plot
-                power_fig, ax = plt.subplots(figsize=(12, 8))
-
-                for i, band in enumerate(bands):
-                    # Fetch power time series for this band and channel
-                    power_data = (
-                        analysis.LFPSpectrogram.ChannelPower
-                        & {
-                            **key,
-                            "band_name": band["band_name"],
-                            "electrode": electrode,
-                        }
-                    ).fetch1("power_time_series")
-
-                    # Robust normalization
-                    if len(power_data) == 0 or np.nanmax(power_data) == 0:
-                        normalized_power = np.zeros_like(t)
-                    else:
-                        normalized_power = power_data / np.nanmax(power_data)
-
-                    ax.plot(
-                        t,
-                        normalized_power,
-                        "-",
-                        color=lfp_colors[i % len(lfp_colors)],
-                        label=band["band_name"],
-                    )
+            # Render the plots of all electrodes in parallel
+            if self.max_workers > 1 and len(plot_jobs) > 1:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    plot_files = list(executor.map(render_channel_plots, plot_jobs))
+            else:
+                plot_files = [render_channel_plots(job) for job in plot_jobs]
 
-                ax.set_xlabel("Time (s)")
-                ax.set_ylabel("Normalized Band Power (unitless)")
-                ax.set_yscale("log")
-                ax.set_title(
-                    f"Band Power Plot\nOrganoid {key['organoid_id']} | {key['start_time']} - {key['end_time']}\nCh {electrode}"
-                )
-                ax.legend(loc="upper left")
-                ax.grid(True)
-
-                # save power plot
-                filename_band_power = (
-                    f"organoid_{key['organoid_id']}_ch{electrode}_"
-                    f"{key['start_time']}_{key['end_time']}_band_power.png"
-                )
-                filepath_band_power = tmp_path / filename_band_power
-                power_fig.savefig(filepath_band_power, bbox_inches="tight", dpi=100)
-                plt.close(power_fig)
-                self.Channel.insert1(
+            execution_duration = (
+                datetime.now(timezone.utc) - execution_start
+            ).total_seconds() / 3600
+
+            # Insert main entries (one per electrode)
+            self.insert(
+                [
                     {
                         **key,
                         "electrode": electrode,
-                        "spectrogram_plot": filepath_spectrogram,
-                        "band_power_plot": filepath_band_power,
+                        "freq_min": freq_min,
+                        "freq_max": freq_max,
+                        "execution_duration": execution_duration,
                     }
-                )
-
-        # Update execution duration
-        self.update1(
-            {
-                **key,
-                "execution_duration": (
-                    datetime.now(timezone.utc) - execution_start
-                ).total_seconds()
-                / 3600,
-            }
+                    for electrode, _, _ in plot_files
+                ]
+            )
+
+            # attachments are read on insert - inside the temporary directory
+            with InsertBuffer(self.Channel) as channel_buffer:
+                for electrode, filepath_spectrogram, filepath_band_power in plot_files:
+                    channel_buffer.add(
+                        {
+                            **key,
+                            "electrode": electrode,
+                            "spectrogram_plot": filepath_spectrogram,
+                            "band_power_plot": filepath_band_power,
+                        }
+                    )
+
+
+# Color scheme for frequency bands
+LFP_COLORS = [
+    "#ad2bea",
+    "#4d3ff8",
+    "#39cabb",
+    "#53e53a",
+    "#e3e12c",
+    "#f7a740",
+    "#ed3838",
+]
+
+
+def get_channel_plot_jobs(key, out_dir, dpi=100, fmt="png", electrodes=None):
+    """
+    Data and rendering options of the spectrogram and band power plots of each electrode (see `render_channel_plots`).
+    Args:
+        key: `analysis.LFPSpectrogram` restriction (a session and param_idx, or a single electrode)
+        out_dir: directory the plots are saved to
+        dpi: plot resolution
+        fmt: plot file format ("png" or "webp")
+        electrodes: electrodes to plot (all if None)
+
+    Returns:
+        plot_jobs: list of dicts, one per electrode
+    """
+    # Frequency display range
+    freq_min = analysis.SpectralBand.fetch("lower_freq").min()
+    freq_max = analysis.SpectralBand.fetch("upper_freq").max()
+
+    electrode_restriction = (
+        [{"electrode": electrode} for electrode in electrodes]
+        if electrodes is not None
+        else {}
+    )
+
+    # Fetch all spectrograms for this recording
+    spectrograms = analysis.fetch_spectrograms(
+        analysis.LFPSpectrogram.ChannelSpectrogram & key & electrode_restriction
+    )
+    bands = analysis.SpectralBand.fetch(as_dict=True)
+
+    # Fetch power time series of all bands and channels in one query
+    power_electrodes, power_bands, power_series = (
+        analysis.LFPSpectrogram.ChannelPower & key & electrode_restriction
+    ).fetch("electrode", "band_name", "power_time_series")
+    band_powers = {
+        (electrode, band_name): power_data
+        for electrode, band_name, power_data in zip(
+            power_electrodes, power_bands, power_series
+        )
+    }
+
+    return [
+        dict(
+            key=key,
+            electrode=ch_data["electrode"],
+            Sxx=ch_data["spectrogram"],
+            t=ch_data["time"],
+            f=ch_data["frequency"],
+            freq_min=freq_min,
+            freq_max=freq_max,
+            bands=bands,
+            band_powers=[
+                band_powers[(ch_data["electrode"], band["band_name"])] for band in bands
+            ],
+            out_dir=out_dir,
+            dpi=dpi,
+            fmt=fmt,
         )
+        for ch_data in spectrograms
+    ]
+
+
+# figures reused across the plots rendered by a process
+_figures = {}
+
+
+def _get_figure(name):
+    """Get a cleared (Agg-backed, pyplot-free) figure, reused within the process."""
+    from matplotlib.figure import Figure
+
+    if name not in _figures:
+        _figures[name] = Figure(figsize=(12, 8))
+    fig = _figures[name]
+    fig.clear()
+    return fig
+
+
+def render_channel_plots(job):
+    """
+    Render the spectrogram and band power plots of one electrode.
+    Args:
+        job: dict with the data of the electrode and the rendering options (see `SpectrogramAndPowerPlots.make`)
+
+    Returns:
+        electrode, spectrogram plot file path, band power plot file path
+    """
+    key, electrode, bands = job["key"], job["electrode"], job["bands"]
+    Sxx, t, f = job["Sxx"], job["t"], job["f"]
+    freq_mask = (f >= job["freq_min"]) & (f <= job["freq_max"])
+
+    # Spectrogram plot
+    spectrogram_fig = _get_figure("spectrogram")
+    ax = spectrogram_fig.add_subplot()
+    im = ax.pcolormesh(t, f[freq_mask], np.log10(Sxx[freq_mask, :]), shading="auto")
+    spectrogram_fig.colorbar(im, ax=ax, label="log Power (μV²/Hz)")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Frequency (Hz)")
+    ax.set_title(
+        f"Spectrogram\nOrganoid {key['organoid_id']} | {key['start_time']} - {key['end_time']}\nCh {electrode}"
+    )
+
+    # Highlight frequency bands
+    for i, band in enumerate(bands):
+        color = LFP_COLORS[i % len(LFP_COLORS)]
+        ax.axhspan(band["lower_freq"], band["upper_freq"], alpha=0.15, color=color)
+        ax.text(
+            -0.05,
+            (band["lower_freq"] + band["upper_freq"]) / 2,
+            band["band_name"],
+            va="center",
+            ha="right",
+            transform=ax.get_yaxis_transform(),
+            color="navy",
+            fontsize=9,
+        )
+
+    # Save spectrogram plot
+    filename_spectrogram = f"organoid_{key['organoid_id']}_ch{electrode}_{key['start_time']}_{key['end_time']}_spectrogram.{job['fmt']}"
+    filepath_spectrogram = Path(job["out_dir"]) / filename_spectrogram
+    spectrogram_fig.savefig(filepath_spectrogram, bbox_inches="tight", dpi=job["dpi"])
+
+    # Band Power Plot
+    power_fig = _get_figure("band_power")
+    ax = power_fig.add_subplot()
+
+    for i, (band, power_data) in enumerate(zip(bands, job["band_powers"])):
+        # Robust normalization
+        if len(power_data) == 0 or np.nanmax(power_data) == 0:
+            normalized_power = np.zeros_like(t)
+        else:
+            normalized_power = power_data / np.nanmax(power_data)
+
+        ax.plot(
+            t,
+            normalized_power,
+            "-",
+            color=LFP_COLORS[i % len(LFP_COLORS)],
+            label=band["band_name"],
+        )
+
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Normalized Band Power (unitless)")
+    ax.set_yscale("log")
+    ax.set_title(
+        f"Band Power Plot\nOrganoid {key['organoid_id']} | {key['start_time']} - {key['end_time']}\nCh {electrode}"
+    )
+    ax.legend(loc="upper left")
+    ax.grid(True)
+
+    # save power plot
+    filename_band_power = (
+        f"organoid_{key['organoid_id']}_ch{electrode}_"
+        f"{key['start_time']}_{key['end_time']}_band_power.{job['fmt']}"
+    )
+    filepath_band_power = Path(job["out_dir"]) / filename_band_power
+    power_fig.savefig(filepath_band_power, bbox_inches="tight", dpi=job["dpi"])
+
+    return electrode, filepath_spectrogram, filepath_band_power
@@ -1,8 +1,21 @@
 import datajoint as dj
 from datajoint_utilities.dj_worker import DataJointWorker, ErrorLog, WorkerLog
 
-from workflow import DB_PREFIX, SUPPORT_DB_PREFIX, WORKER_MAX_IDLED_CYCLE
-from workflow.pipeline import analysis, ephys, ephys_report, ephys_sorter, mua, report
+from workflow import (
+    DB_PREFIX,
+    PRECOMPUTE_PLOTS,
+    SUPPORT_DB_PREFIX,
+    WORKER_MAX_IDLED_CYCLE,
+)
+from workflow.pipeline import (
+    analysis,
+    ephys,
+    ephys_report,
+    ephys_sorter,
+    frame,
+    mua,
+    report,
+)
 from workflow.support import ingestion_support
 
 logger = dj.logger
@@ -44,8 +57,12 @@ spike_sorting_worker = DataJointWorker(
 
 # mua
 # standard_worker(mua.MUAEphysSession, max_calls=20)
+standard_worker(mua.EphysRawFileHeader, max_calls=200)
 standard_worker(mua.MUASpikes, max_calls=20)
-standard_worker(mua.MUATracePlot, max_calls=20)
+standard_worker(frame.PopulationRate, max_calls=200)
+# plots are rendered on demand (`workflow.utils.plot_service`) unless precomputed
+if PRECOMPUTE_PLOTS:
+    standard_worker(mua.MUATracePlot, max_calls=20)
 
 # ephys LFP
 standard_worker(ingestion_support.FileProcessing)
@@ -53,7 +70,8 @@ standard_worker(ephys.EphysSessionInfo, max_calls=200)
 standard_worker(ephys.LFP, max_calls=20)
 standard_worker(analysis.LFPQC, max_calls=20)
 standard_worker(analysis.LFPSpectrogram, max_calls=20)
-standard_worker(report.SpectrogramAndPowerPlots, max_calls=10)
+if PRECOMPUTE_PLOTS:
+    standard_worker(report.SpectrogramAndPowerPlots, max_calls=10)
 
 # ephys spike sorting
 spike_sorting_worker(ephys_sorter.PreProcessing, max_calls=6)
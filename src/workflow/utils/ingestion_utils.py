@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import re
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 from uuid import UUID
@@ -30,6 +31,12 @@ def get_channel_to_electrode_map(port_id: str | None = None) -> dict[str, int]:
     Returns:
         dict[str, int]: channel to electrode number mapping.
     """
+    return dict(_get_channel_to_electrode_items(port_id))
+
+
+@lru_cache(maxsize=None)
+def _get_channel_to_electrode_items(port_id: str | None) -> tuple[tuple[str, int], ...]:
+    """Sorted (channel, electrode) pairs of `get_channel_to_electrode_map`, built once per port."""
     if port_id in ["A", "B", "C", "D"]:
         channel_to_electrode_map = {
             f"{port_id}-{value:03}": key for key, value in enumerate(El2ROW)
@@ -40,9 +47,9 @@ def get_channel_to_electrode_map(port_id: str | None = None) -> dict[str, int]:
         raise ValueError(f"Invalid port_id: {port_id}")
 
     # Sort by the key
-    return {
-        key: channel_to_electrode_map[key] for key in sorted(channel_to_electrode_map)
-    }
+    return tuple(
+        (key, channel_to_electrode_map[key]) for key in sorted(channel_to_electrode_map)
+    )
 
 
 def ingest_experiment():
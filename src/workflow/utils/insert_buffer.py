@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from typing import Any
+
+import datajoint as dj
+
+from workflow import INSERT_BATCH_SIZE
+
+
+class InsertBuffer:
+    """Collect rows for a table during `make()` and insert them in bulk.
+
+    Rows are inserted every `batch_size` rows and when the context exits without error, so a
+    part table is filled with a handful of round-trips instead of one `insert1` per row.
+
+    Args:
+        table (dj.Table): Table (usually a part table) to insert into.
+        batch_size (int | None, optional): Number of rows per insert. Defaults to `INSERT_BATCH_SIZE`.
+        transaction (bool, optional): Wrap all inserts in one transaction. Inside `populate()`, where
+            each key already runs in its own transaction, the existing transaction is used. Defaults to False.
+        **insert_kwargs: Keyword arguments passed on to `table.insert` (e.g. `skip_duplicates`).
+
+    Example:
+        >>> with InsertBuffer(self.Channel) as channel_buffer:
+        ...     for ch_idx, ch_id in enumerate(channel_ids):
+        ...         channel_buffer.add({**key, "channel_idx": ch_idx, "channel_id": ch_id})
+    """
+
+    def __init__(
+        self,
+        table: dj.Table,
+        batch_size: int | None = None,
+        transaction: bool = False,
+        **insert_kwargs,
+    ):
+        self.table = table
+        self.batch_size = batch_size or INSERT_BATCH_SIZE
+        self.transaction = transaction
+        self.insert_kwargs = insert_kwargs
+        self._rows: list[dict[str, Any]] = []
+        self._own_transaction = False
+
+    def add(self, row: dict[str, Any]) -> None:
+        """Add a row, inserting the buffered rows once `batch_size` is reached."""
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows) -> None:
+        """Add several rows."""
+        for row in rows:
+            self.add(row)
+
+    def flush(self) -> None:
+        """Insert all buffered rows."""
+        if self._rows:
+            self.table.insert(self._rows, **self.insert_kwargs)
+            self._rows = []
+
+    def __enter__(self) -> InsertBuffer:
+        connection = self.table.connection
+        if self.transaction and not connection.in_transaction:
+            connection.start_transaction()
+            self._own_transaction = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+        except Exception:
+            self._close_transaction(commit=False)
+            raise
+        self._close_transaction(commit=exc_type is None)
+
+    def _close_transaction(self, commit: bool) -> None:
+        self._rows = []
+        if self._own_transaction:
+            if commit:
+                self.table.connection.commit_transaction()
+            else:
+                self.table.connection.cancel_transaction()
+        self._own_transaction = False
@@ -1,4 +1,5 @@
 import subprocess
+import tempfile
 from pathlib import Path
 from typing import Any, Literal
 
@@ -16,6 +17,20 @@ def get_processed_root_data_dir() -> Path:
     return Path(data_dir) if data_dir else None
 
 
+def get_trace_cache_dir() -> Path:
+    """Directory of the preprocessed trace cache (None if not configured, i.e. the cache is disabled)"""
+    cache_dir = dj.config.get("custom", {}).get("trace_cache_dir")
+    return Path(cache_dir) if cache_dir else None
+
+
+def get_plot_cache_dir() -> Path:
+    """Directory of the on-demand plot cache (defaults to a local folder in the temp directory)"""
+    cache_dir = dj.config.get("custom", {}).get("plot_cache_dir")
+    if cache_dir:
+        return Path(cache_dir)
+    return Path(tempfile.gettempdir()) / "plot_cache"
+
+
 def get_ephys_root_data_dir() -> Path:
     return get_raw_root_data_dir()
 
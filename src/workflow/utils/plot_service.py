@@ -0,0 +1,254 @@
+"""On-demand rendering of the spectrogram, band power, waveform and trace plots.
+
+Plots are rendered from the stored numeric data the first time they are requested and kept in a
+size-bounded LRU cache on disk, so the precomputed plot tables (`report.SpectrogramAndPowerPlots`,
+`mua.MUATracePlot`) are optional (see `PRECOMPUTE_PLOTS`).
+
+Example:
+    >>> from workflow.utils import plot_service
+    >>> spectrogram_png, band_power_png = plot_service.get_spectrogram_plots(key, electrode=3)
+    >>> fig = pio.from_json(plot_service.get_trace_plot(key, channel_idx=3))
+"""
+
+from __future__ import annotations
+
+import fcntl
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any
+
+import matplotlib.pyplot as plt
+import numpy as np
+from element_interface.utils import dict_to_uuid
+
+from workflow import PLOT_CACHE_MAX_GB
+from workflow.utils.paths import get_plot_cache_dir
+from workflow.utils.signal_utils import minmax_decimate_indices, snippet_summary
+
+
+class PlotCache:
+    """On-disk LRU store of rendered plots, one file per plot.
+
+    Plots are returned as file contents (read in one step), so an entry evicted by another process
+    is simply rendered again. Eviction is serialized between processes with a lock file in the cache
+    directory.
+
+    Args:
+        cache_dir (str | Path | None, optional): Cache directory. Defaults to `get_plot_cache_dir()`.
+        max_bytes (int | None, optional): Maximum total size of the cache, 0 to disable eviction.
+            Defaults to `PLOT_CACHE_MAX_GB`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path | None = None,
+        max_bytes: int | None = None,
+    ):
+        self.cache_dir = Path(cache_dir or get_plot_cache_dir())
+        self.max_bytes = (
+            int(PLOT_CACHE_MAX_GB * 1024**3) if max_bytes is None else max_bytes
+        )
+
+    @staticmethod
+    def get_cache_key(name: str, key: dict[str, Any], **options) -> str:
+        """Content address of plot `name` of `key` rendered with `options`."""
+        return str(dict_to_uuid({**key, "plot_name": name, **options}))
+
+    def read(self, cache_key: str, suffix: str) -> bytes | None:
+        """Content of the cached plot, or None if not cached (or evicted concurrently)."""
+        path = self.cache_dir / f"{cache_key}{suffix}"
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return content
+
+    def put(self, cache_key: str, suffix: str, src: Path) -> bytes:
+        """Move the rendered plot file `src` into the cache and return its content."""
+        content = Path(src).read_bytes()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / f"{cache_key}{suffix}"
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        shutil.move(src, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return content
+
+    def evict(self) -> None:
+        """Remove the least recently used plots until the cache fits within `max_bytes`."""
+        if not self.max_bytes or not self.cache_dir.exists():
+            return
+
+        with open(self.cache_dir / ".evict.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self.cache_dir.glob("*"):
+            if path.suffix in (".tmp", ".lock"):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+
+
+def get_spectrogram_plots(
+    key: dict[str, Any],
+    electrode: int,
+    dpi: int = 100,
+    fmt: str = "png",
+    plot_cache: PlotCache | None = None,
+) -> tuple[bytes, bytes]:
+    """Spectrogram and band power plots of an electrode of an `analysis.LFPSpectrogram` entry.
+
+    Args:
+        key (dict): `analysis.LFPSpectrogram` key (session and param_idx).
+        electrode (int): Electrode index.
+        dpi (int, optional): Plot resolution. Defaults to 100.
+        fmt (str, optional): "png" or "webp". Defaults to "png".
+        plot_cache (PlotCache | None, optional): Plot cache. Defaults to `PlotCache()`.
+
+    Returns:
+        tuple[bytes, bytes]: Spectrogram and band power plot files (in `fmt`).
+    """
+    from workflow.pipeline import analysis, report
+
+    plot_cache = plot_cache or PlotCache()
+    key = (analysis.LFPSpectrogram & key & {"electrode": electrode}).fetch1("KEY")
+    suffix = f".{fmt}"
+    cache_keys = [
+        plot_cache.get_cache_key(name, key, electrode=electrode, dpi=dpi)
+        for name in ("spectrogram", "band_power")
+    ]
+    cached = [plot_cache.read(cache_key, suffix) for cache_key in cache_keys]
+    if all(content is not None for content in cached):
+        return tuple(cached)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (plot_job,) = report.get_channel_plot_jobs(
+            key, tmpdir, dpi=dpi, fmt=fmt, electrodes=[electrode]
+        )
+        _, *plot_files = report.render_channel_plots(plot_job)
+        return tuple(
+            plot_cache.put(cache_key, suffix, plot_file)
+            for cache_key, plot_file in zip(cache_keys, plot_files)
+        )
+
+
+def get_waveform_plot(
+    key: dict[str, Any],
+    channel_idx: int,
+    plot_cache: PlotCache | None = None,
+) -> bytes:
+    """Mean waveform plot (PNG) of a `mua.MUASpikes.Channel` entry.
+
+    Args:
+        key (dict): `mua.MUASpikes` key.
+        channel_idx (int): Channel index.
+        plot_cache (PlotCache | None, optional): Plot cache. Defaults to `PlotCache()`.
+
+    Returns:
+        bytes: Waveform plot PNG file.
+    """
+    from workflow.pipeline import mua
+
+    plot_cache = plot_cache or PlotCache()
+    key = (mua.MUASpikes & key).fetch1("KEY")
+    cache_key = plot_cache.get_cache_key("waveform", key, channel_idx=channel_idx)
+    if (cached := plot_cache.read(cache_key, ".png")) is not None:
+        return cached
+
+    chn_data = (mua.MUASpikes.Channel & key & {"channel_idx": channel_idx}).fetch1()
+    traces, fs, channel_ids = mua.get_preprocessed_traces(key)
+    spk_ind = mua.get_plot_spike_indices(
+        chn_data, (mua.MUASpikes & key).fetch1("peak_sign")
+    )
+
+    # average waveform - 2ms before and after the spike
+    pad_len = int(2e-3 * fs)
+    waveforms = snippet_summary(traces[:, [channel_idx]], [spk_ind], pad_len, pad_len)
+    mean_wf = waveforms["mean"][0] if waveforms["count"][0] > 0 else np.array([])
+
+    title = f"{key['organoid_id']} | {key['start_time']} | ChnID: {channel_ids[channel_idx]}"
+    wf_fig = mua.plot_mean_waveform(mean_wf, fs, title)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / "waveform.png"
+        wf_fig.savefig(filepath)
+        plt.close(wf_fig)
+        return plot_cache.put(cache_key, ".png", filepath)
+
+
+def get_trace_plot(
+    key: dict[str, Any],
+    channel_idx: int,
+    max_trace_points: int | None = 20000,
+    plot_cache: PlotCache | None = None,
+) -> str:
+    """Trace plot (plotly JSON) with the detected spikes of a `mua.MUASpikes.Channel` entry.
+
+    Args:
+        key (dict): `mua.MUASpikes` key.
+        channel_idx (int): Channel index.
+        max_trace_points (int | None, optional): Max number of envelope points, None for the full trace.
+            Defaults to 20000.
+        plot_cache (PlotCache | None, optional): Plot cache. Defaults to `PlotCache()`.
+
+    Returns:
+        str: Plotly figure JSON (load with `plotly.io.from_json`).
+    """
+    from workflow.pipeline import mua
+
+    plot_cache = plot_cache or PlotCache()
+    key = (mua.MUASpikes & key).fetch1("KEY")
+    cache_key = plot_cache.get_cache_key(
+        "trace", key, channel_idx=channel_idx, max_trace_points=max_trace_points
+    )
+    if (cached := plot_cache.read(cache_key, ".json")) is not None:
+        return cached.decode()
+
+    chn_data = (mua.MUASpikes.Channel & key & {"channel_idx": channel_idx}).fetch1()
+    traces, fs, channel_ids = mua.get_preprocessed_traces(key)
+    spk_ind = mua.get_plot_spike_indices(
+        chn_data, (mua.MUASpikes & key).fetch1("peak_sign")
+    )
+    trace = np.asarray(traces[:, channel_idx])
+    times = np.arange(len(trace)) / fs
+    ch_id = channel_ids[channel_idx]
+
+    plot_indices = (
+        minmax_decimate_indices(trace, max_trace_points, keep_indices=spk_ind)
+        if max_trace_points
+        else None
+    )
+    trace_fig = mua.plot_trace_with_peaks(
+        trace,
+        times,
+        spk_ind,
+        f"ch_{ch_id}",
+        f"{key['organoid_id']} | {key['start_time']} | ChnID: {ch_id}",
+        plot_indices=plot_indices,
+    )
+    trace_json = trace_fig.to_json()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / "trace.json"
+        filepath.write_text(trace_json)
+        plot_cache.put(cache_key, ".json", filepath)
+    return trace_json
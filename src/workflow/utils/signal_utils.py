@@ -0,0 +1,449 @@
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, find_peaks, hilbert, sosfiltfilt
+from scipy.stats import median_abs_deviation
+
+
+@lru_cache(maxsize=256)
+def get_bandpass_sos(
+    fs: float, band: tuple[float, float], order: int = 4
+) -> np.ndarray:
+    """Butterworth band-pass filter as second-order sections, cached by (fs, band, order).
+
+    Args:
+        fs (float): Sampling frequency in Hz.
+        band (tuple[float, float]): Lower and upper cutoff frequencies in Hz.
+        order (int, optional): Filter order. Defaults to 4.
+
+    Returns:
+        np.ndarray: Second-order sections, shared between callers (do not modify in place).
+    """
+    return butter(order, np.asarray(band) / (fs / 2), btype="bandpass", output="sos")
+
+
+def bandpass_filter(
+    traces: np.ndarray,
+    fs: float,
+    band: tuple[float, float],
+    order: int = 4,
+    axis: int = 0,
+) -> np.ndarray:
+    """Zero-phase band-pass filter of all traces in a single call.
+
+    Args:
+        traces (np.ndarray): Traces, e.g. (samples x channels).
+        fs (float): Sampling frequency in Hz.
+        band (tuple[float, float]): Lower and upper cutoff frequencies in Hz.
+        order (int, optional): Filter order. Defaults to 4.
+        axis (int, optional): Time axis of `traces`. Defaults to 0.
+
+    Returns:
+        np.ndarray: Filtered traces.
+    """
+    sos = get_bandpass_sos(float(fs), tuple(float(freq) for freq in band), order)
+    return sosfiltfilt(sos, traces, axis=axis)
+
+
+def band_power_envelope(
+    traces: np.ndarray,
+    fs: float,
+    band: tuple[float, float],
+    order: int = 4,
+    axis: int = 0,
+) -> np.ndarray:
+    """Instantaneous power (squared Hilbert envelope) of the band-passed traces.
+
+    Args:
+        traces (np.ndarray): Traces, e.g. (samples x channels).
+        fs (float): Sampling frequency in Hz.
+        band (tuple[float, float]): Lower and upper cutoff frequencies in Hz.
+        order (int, optional): Filter order. Defaults to 4.
+        axis (int, optional): Time axis of `traces`. Defaults to 0.
+
+    Returns:
+        np.ndarray: Band power signal of each trace.
+    """
+    filtered = bandpass_filter(traces, fs, band, order=order, axis=axis)
+    return np.abs(hilbert(filtered, axis=axis)) ** 2
+
+
+def extract_snippets(
+    trace: np.ndarray,
+    indices: np.ndarray,
+    n_before: int,
+    n_after: int,
+) -> np.ndarray:
+    """Windows `trace[idx - n_before : idx + n_after]` around all indices at once.
+
+    Indices whose window does not fit within the trace are skipped.
+
+    Args:
+        trace (np.ndarray): Trace (samples,) or traces (samples x channels).
+        indices (np.ndarray): Sample indices, e.g. spike indices.
+        n_before (int): Number of samples before each index.
+        n_after (int): Number of samples after each index (exclusive).
+
+    Returns:
+        np.ndarray: Snippets (snippets x window), or (snippets x window x channels) for 2D traces.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    valid = (indices - n_before >= 0) & (indices + n_after < len(trace))
+    windows = indices[valid, None] + np.arange(-n_before, n_after)
+    return np.asarray(trace)[windows]
+
+
+def snippet_summary(
+    traces: np.ndarray,
+    indices: list[np.ndarray],
+    n_before: int,
+    n_after: int,
+    stats: bool = False,
+    percentiles: tuple[float, ...] = (5, 95),
+) -> dict[str, np.ndarray]:
+    """Mean (and optionally median and percentile) waveforms of the snippets of several channels.
+
+    Args:
+        traces (np.ndarray): Traces (samples x channels).
+        indices (list[np.ndarray]): Sample indices for each channel (e.g. spike indices).
+        n_before (int): Number of samples before each index.
+        n_after (int): Number of samples after each index (exclusive).
+        stats (bool, optional): Also compute the median and percentile waveforms (sorts the
+            snippets, much slower than the mean). Defaults to False.
+        percentiles (tuple[float, ...], optional): Percentiles to compute if `stats`. Defaults to (5, 95).
+
+    Returns:
+        dict[str, np.ndarray]: "count" (channels,) number of valid snippets and "mean" (channels x window);
+            if `stats`, also "median" (channels x window) and "percentiles" (channels x percentiles x window).
+            Channels without valid snippets are NaN.
+    """
+    num_channels, window = len(indices), n_before + n_after
+    dtype = np.result_type(traces.dtype, np.float32)
+    summary = {
+        "count": np.zeros(num_channels, dtype=int),
+        "mean": np.full((num_channels, window), np.nan, dtype=dtype),
+    }
+    if stats:
+        summary["median"] = np.full((num_channels, window), np.nan, dtype=dtype)
+        summary["percentiles"] = np.full(
+            (num_channels, len(percentiles), window), np.nan, dtype=dtype
+        )
+    for ch_idx, ch_indices in enumerate(indices):
+        snippets = extract_snippets(traces[:, ch_idx], ch_indices, n_before, n_after)
+        summary["count"][ch_idx] = len(snippets)
+        if not len(snippets):
+            continue
+        summary["mean"][ch_idx] = snippets.mean(axis=0)
+        if stats:
+            summary["median"][ch_idx] = np.median(snippets, axis=0)
+            summary["percentiles"][ch_idx] = np.percentile(
+                snippets, percentiles, axis=0
+            )
+    return summary
+
+
+def minmax_decimate_indices(
+    trace: np.ndarray,
+    max_points: int,
+    keep_indices: np.ndarray | None = None,
+) -> np.ndarray:
+    """Sample indices of a min/max envelope decimation of a trace for plotting.
+
+    The trace is split into `max_points // 2` buckets and the minimum and maximum of each bucket are
+    kept, so peaks remain visible however far the trace is decimated.
+
+    Args:
+        trace (np.ndarray): Trace (samples,).
+        max_points (int): Maximum number of envelope points.
+        keep_indices (np.ndarray | None, optional): Indices that are always kept (e.g. spike indices).
+
+    Returns:
+        np.ndarray: Sorted unique sample indices to plot.
+    """
+    num_samples = len(trace)
+    if num_samples <= max_points:
+        indices = np.arange(num_samples)
+    else:
+        num_buckets = max(max_points // 2, 1)
+        bucket_size = -(-num_samples // num_buckets)  # ceil division
+        padded = np.pad(
+            trace, (0, num_buckets * bucket_size - num_samples), mode="edge"
+        )
+        buckets = padded.reshape(num_buckets, bucket_size)
+        offsets = np.arange(num_buckets) * bucket_size
+        indices = np.concatenate(
+            [
+                [0, num_samples - 1],
+                np.minimum(offsets + buckets.argmin(axis=1), num_samples - 1),
+                np.minimum(offsets + buckets.argmax(axis=1), num_samples - 1),
+            ]
+        )
+    if keep_indices is not None:
+        indices = np.concatenate([indices, np.asarray(keep_indices, dtype=np.int64)])
+    return np.unique(indices)
+
+
+def detect_spikes(
+    traces: np.ndarray,
+    fs: float,
+    threshold_uV: float,
+    peak_sign: str = "both",
+    refractory_period: float = 0.002,
+    noise_levels: np.ndarray | None = None,
+) -> tuple[np.ndarray, list[np.ndarray], list[np.ndarray]]:
+    """Threshold-crossing peaks on all channels of a trace block at once.
+
+    Same peaks as `scipy.signal.find_peaks(signal, height=threshold, distance=refractory_samples)`
+    on each channel, where the threshold is max(`threshold_uV`, 5 x MAD noise level). Only equal-height
+    peaks closer than the refractory period may differ: here the earlier one is kept, whereas
+    `find_peaks` resolves such ties in the order of an unstable sort.
+
+    Args:
+        traces (np.ndarray): Traces (samples x channels) in uV.
+        fs (float): Sampling frequency in Hz.
+        threshold_uV (float): Minimum detection threshold in uV.
+        peak_sign (str, optional): "neg", "pos" or "both". Defaults to "both".
+        refractory_period (float, optional): Minimum distance between spikes in seconds. Defaults to 0.002.
+        noise_levels (np.ndarray | None, optional): Noise level (channels,) in uV, computed from `traces`
+            if not provided.
+
+    Returns:
+        tuple[np.ndarray, list[np.ndarray], list[np.ndarray]]: Noise level (channels,), spike indices in
+            samples and spike amplitudes in uV (one array per channel).
+    """
+    traces = np.asarray(traces)
+    num_samples, num_channels = traces.shape
+
+    if noise_levels is None:
+        noise_levels = median_abs_deviation(traces, axis=0, scale="normal")
+    thresholds = np.maximum(threshold_uV, 5 * np.asarray(noise_levels))
+    distance = max(int(refractory_period * fs), 1)
+
+    if peak_sign == "neg":
+        signal = -traces
+    elif peak_sign == "both":
+        signal = np.abs(traces)
+    else:
+        signal = traces
+
+    # supra-threshold samples, ordered by channel then sample (first and last samples cannot be peaks)
+    ch, idx = np.nonzero((signal[1:-1] >= thresholds).T)
+    idx += 1
+    height = signal[idx, ch]
+
+    # channels with flat-topped peaks fall back to `find_peaks` (plateau midpoint handling)
+    plateau_channels = np.unique(ch[signal[idx + 1, ch] == height])
+    is_peak = (signal[idx - 1, ch] < height) & (signal[idx + 1, ch] < height)
+    is_peak &= ~np.isin(ch, plateau_channels)
+    ch, idx, height = ch[is_peak], idx[is_peak], height[is_peak]
+
+    keep = select_by_distance(ch * (num_samples + distance) + idx, height, distance)
+    ch, idx = ch[keep], idx[keep]
+
+    bounds = np.searchsorted(ch, np.arange(num_channels + 1))
+    spike_indices = [idx[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    for ch_idx in plateau_channels:
+        spike_indices[ch_idx], _ = find_peaks(
+            signal[:, ch_idx], height=thresholds[ch_idx], distance=distance
+        )
+    spike_amps = [
+        traces[spk_ind, ch_idx] for ch_idx, spk_ind in enumerate(spike_indices)
+    ]
+
+    return noise_levels, spike_indices, spike_amps
+
+
+def select_by_distance(
+    positions: np.ndarray, priority: np.ndarray, distance: int
+) -> np.ndarray:
+    """Vectorized counterpart of the `find_peaks` distance criterion.
+
+    Peaks are kept in descending order of priority (the earlier peak first on ties), removing any
+    peak closer than `distance` to a kept one. Peaks that are the highest among their undecided
+    neighbours are resolved together, so the number of iterations only depends on the longest chain
+    of competing peaks.
+
+    Args:
+        positions (np.ndarray): Sorted peak positions.
+        priority (np.ndarray): Peak heights.
+        distance (int): Minimum distance between kept peaks.
+
+    Returns:
+        np.ndarray: Boolean mask of the kept peaks.
+    """
+    num_peaks = len(positions)
+    rank = np.empty(num_peaks, dtype=int)
+    # higher rank wins, ties go to the earlier position
+    rank[np.lexsort((-np.arange(num_peaks), priority))] = np.arange(num_peaks)
+
+    # neighbours closer than `distance`, as offsets into the sorted positions
+    left_count = np.arange(num_peaks) - np.searchsorted(
+        positions, positions - distance + 1, side="left"
+    )
+    right_count = (
+        np.searchsorted(positions, positions + distance - 1, side="right")
+        - np.arange(num_peaks)
+        - 1
+    )
+    neighbours = []
+    for offset in range(
+        1, max(left_count.max(initial=0), right_count.max(initial=0)) + 1
+    ):
+        left = np.nonzero(left_count >= offset)[0]
+        right = np.nonzero(right_count >= offset)[0]
+        neighbours.append(
+            (
+                np.concatenate([left, right]),
+                np.concatenate([left - offset, right + offset]),
+            )
+        )
+
+    state = np.zeros(num_peaks, dtype=int)  # 0: undecided, 1: kept, -1: removed
+    while np.any(state == 0):
+        undecided = state == 0
+        is_max = undecided.copy()
+        for i, j in neighbours:
+            blocked = undecided[j] & (rank[j] > rank[i])
+            is_max[i[blocked]] = False
+        state[is_max] = 1
+        for i, j in neighbours:
+            state[j[is_max[i] & (state[j] == 0)]] = -1
+
+    return state == 1
+
+
+def build_population_rate(
+    times: np.ndarray,
+    grid_start,
+    bin_size,
+    num_bins: int,
+    values: np.ndarray | None = None,
+    electrode_ids: np.ndarray | None = None,
+    num_elec_inside: int | None = None,
+) -> np.ndarray:
+    """Sum spike counts or rates onto a regular time grid in a single pass.
+
+    Args:
+        times (np.ndarray): Time of each entry (numeric or datetime64).
+        grid_start: Start of the first bin (same units as `times`).
+        bin_size: Width of each bin (same units as `times`).
+        num_bins (int): Number of bins in the grid.
+        values (np.ndarray | None, optional): Weight of each entry (e.g. spike rates). Counts
+            entries if None.
+        electrode_ids (np.ndarray | None, optional): Electrode index of each entry.
+        num_elec_inside (int | None, optional): Only entries with electrode_ids in
+            [0, num_elec_inside) are kept (-1 marks unmapped channels).
+
+    Returns:
+        np.ndarray: Binned population vector of length `num_bins` (bins are half-open, entries
+            outside the grid are dropped).
+    """
+    times = np.asarray(times)
+    keep = np.ones(times.shape, dtype=bool)
+
+    # only consider electrodes inside organoid
+    if num_elec_inside is not None:
+        electrode_ids = np.asarray(electrode_ids)
+        keep &= (electrode_ids >= 0) & (electrode_ids < num_elec_inside)
+
+    # map every entry to its bin with index arithmetic
+    bin_indices = np.floor((times - grid_start) / bin_size).astype(np.int64)
+    keep &= (bin_indices >= 0) & (bin_indices < num_bins)
+
+    weights = None if values is None else np.asarray(values, dtype=float)[keep]
+    return np.bincount(bin_indices[keep], weights=weights, minlength=num_bins)
+
+
+def add_population_minutes(
+    grid_start: np.datetime64 | None,
+    population_firing_vector: np.ndarray,
+    smoothed_firing_vector: np.ndarray,
+    start_time_offsets: np.ndarray,
+    start_times: np.ndarray,
+    population_rates: np.ndarray,
+    window: int,
+) -> tuple[np.datetime64, np.ndarray, np.ndarray, np.ndarray]:
+    """Add MUA minutes, in any order, to a per-minute population firing vector.
+
+    The minutes may fall anywhere on the grid (also before `grid_start`, which is then moved back);
+    the boxcar-smoothed vector (trailing mean over `window` minutes, as `bottleneck.move_mean` with
+    `min_count=1`) is only recomputed from the first changed minute on.
+
+    Args:
+        grid_start (np.datetime64 | None): Minute of the first element, None if the vectors are empty.
+        population_firing_vector (np.ndarray): Population firing rate per minute.
+        smoothed_firing_vector (np.ndarray): Boxcar-smoothed population firing vector.
+        start_time_offsets (np.ndarray): Start times of the included minutes (seconds from `grid_start`).
+        start_times (np.ndarray): Start times of the new minutes (must not be included yet).
+        population_rates (np.ndarray): Population firing rate of each new minute.
+        window (int): Boxcar length in minutes.
+
+    Returns:
+        tuple: Updated `grid_start`, `population_firing_vector`, `smoothed_firing_vector` and
+            `start_time_offsets` (sorted).
+    """
+    start_times = np.asarray(start_times, dtype="datetime64[s]")
+    if not len(start_times):
+        return (
+            grid_start,
+            population_firing_vector,
+            smoothed_firing_vector,
+            start_time_offsets,
+        )
+
+    one_minute = np.timedelta64(1, "m")
+    start_minutes = start_times.astype("datetime64[m]")
+    population_firing_vector = np.asarray(population_firing_vector, dtype=float)
+    smoothed_firing_vector = np.asarray(smoothed_firing_vector, dtype=float)
+    start_time_offsets = np.asarray(start_time_offsets, dtype=np.int64)
+
+    # move the grid start back if a new minute precedes it
+    if grid_start is None:
+        grid_start = start_minutes.min()
+    elif start_minutes.min() < grid_start:
+        shift = int((grid_start - start_minutes.min()) / one_minute)
+        population_firing_vector = np.concatenate(
+            [np.zeros(shift), population_firing_vector]
+        )
+        smoothed_firing_vector = np.concatenate(
+            [np.zeros(shift), smoothed_firing_vector]
+        )
+        start_time_offsets = start_time_offsets + shift * 60
+        grid_start = start_minutes.min()
+
+    # add the new minutes to the (extended) grid
+    bins = ((start_minutes - grid_start) / one_minute).astype(np.int64)
+    num_bins = max(int(bins.max()) + 1, len(population_firing_vector))
+    population_firing_vector = np.concatenate(
+        [
+            population_firing_vector,
+            np.zeros(num_bins - len(population_firing_vector)),
+        ]
+    )
+    population_firing_vector += build_population_rate(
+        start_minutes, grid_start, one_minute, num_bins, values=population_rates
+    )
+
+    # trailing mean from the first changed minute on (earlier values are unaffected)
+    first_bin = int(bins.min())
+    cumulative = np.concatenate([[0.0], np.cumsum(population_firing_vector)])
+    ends = np.arange(first_bin, num_bins) + 1
+    starts = np.maximum(ends - window, 0)
+    smoothed_firing_vector = np.concatenate(
+        [
+            smoothed_firing_vector[:first_bin],
+            (cumulative[ends] - cumulative[starts]) / (ends - starts),
+        ]
+    )
+
+    new_offsets = ((start_times - grid_start) / np.timedelta64(1, "s")).astype(np.int64)
+    start_time_offsets = np.sort(np.concatenate([start_time_offsets, new_offsets]))
+
+    return (
+        grid_start,
+        population_firing_vector,
+        smoothed_firing_vector,
+        start_time_offsets,
+    )
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from element_interface.utils import dict_to_uuid
+from numpy.lib.format import open_memmap
+
+from workflow import TRACE_CACHE_MAX_GB
+from workflow.utils.paths import get_trace_cache_dir
+
+
+class TraceCache:
+    """On-disk cache of preprocessed traces, stored as memory-mapped float32 `.npy` files.
+
+    Entries are addressed by a hash of the session key and the preprocessing parameters, so the same
+    traces are shared between tables (e.g. `MUASpikes` and `MUATracePlot`) and notebooks. The least
+    recently used entries are evicted once the cache grows beyond `max_bytes`. The cache is opt-in: if no
+    cache directory is configured (`TRACE_CACHE_DIR`), `get` returns None and nothing is written.
+
+    Eviction is serialized between processes with a lock file in the cache directory. Entries memory-mapped
+    by a process on another host may still be removed; for a cache shared over NFS, set `max_bytes` to 0
+    (`TRACE_CACHE_MAX_GB=0`) to disable eviction and clean the directory up externally.
+
+    Args:
+        cache_dir (str | Path | None, optional): Cache directory. Defaults to `get_trace_cache_dir()`.
+        max_bytes (int | None, optional): Maximum total size of the cache, 0 to disable eviction.
+            Defaults to `TRACE_CACHE_MAX_GB`.
+
+    Example:
+        >>> trace_cache = TraceCache()
+        >>> cache_key = trace_cache.get_cache_key(session_key, {"freq_min": 300, "freq_max": 6000})
+        >>> traces, metadata = trace_cache.get(cache_key) or (None, None)
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path | None = None,
+        max_bytes: int | None = None,
+    ):
+        cache_dir = cache_dir or get_trace_cache_dir()
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_bytes = (
+            int(TRACE_CACHE_MAX_GB * 1024**3) if max_bytes is None else max_bytes
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_dir is not None
+
+    @staticmethod
+    def get_cache_key(key: dict[str, Any], params: dict[str, Any]) -> str:
+        """Content address of the traces of `key` preprocessed with `params`."""
+        return str(dict_to_uuid({**key, **params}))
+
+    def get(self, cache_key: str) -> tuple[np.memmap, dict[str, Any]] | None:
+        """Map the cached traces (read-only) and their metadata, or return None if not cached."""
+        if not self.enabled:
+            return None
+        data_path, meta_path = self._paths(cache_key)
+        try:
+            metadata = json.loads(meta_path.read_text())
+            traces = np.load(data_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # mark as recently used (the mapped traces stay valid if the entry was evicted meanwhile)
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            pass
+        return traces, metadata
+
+    def put(self, cache_key: str, traces: np.ndarray, **metadata) -> None:
+        """Write `traces` (samples x channels) to the cache."""
+        with self.open_writer(cache_key, traces.shape, **metadata) as out:
+            if out is not None:
+                out[:] = traces
+
+    @contextmanager
+    def open_writer(self, cache_key: str, shape: tuple[int, ...], **metadata):
+        """Yield a writable float32 memmap of `shape` to be filled in place (e.g. chunk by chunk).
+
+        The entry only becomes visible to `get` once the context exits without error. Yields None if
+        the cache is disabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        data_path, meta_path = self._paths(cache_key)
+        tmp_path = data_path.with_name(f"{data_path.stem}.{os.getpid()}.tmp.npy")
+
+        out = open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+        try:
+            yield out
+            out.flush()
+            os.replace(tmp_path, data_path)
+            meta_path.write_text(json.dumps(metadata, default=str))
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits within `max_bytes`."""
+        if not self.enabled or not self.max_bytes or not self.cache_dir.exists():
+            return
+
+        with open(self.cache_dir / ".evict.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for meta_path in self.cache_dir.glob("*.json"):
+            data_path = meta_path.with_suffix(".npy")
+            try:
+                entries.append(
+                    (meta_path.stat().st_mtime, data_path.stat().st_size, meta_path)
+                )
+            except OSError:
+                continue
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, meta_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            meta_path.unlink(missing_ok=True)
+            meta_path.with_suffix(".npy").unlink(missing_ok=True)
+            total_bytes -= size
+
+    def _paths(self, cache_key: str) -> tuple[Path, Path]:
+        return (
+            self.cache_dir / f"{cache_key}.npy",
+            self.cache_dir / f"{cache_key}.json",
+        )
@@ -0,0 +1,114 @@
+import numpy as np
+
+from scipy.signal import find_peaks
+
+from workflow.utils.signal_utils import (
+    add_population_minutes,
+    detect_spikes,
+    select_by_distance,
+)
+
+
+def _empty_activity():
+    return None, np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+
+
+def _start_times(minutes):
+    grid_start = np.datetime64("2024-01-01T00:00", "s")
+    return (
+        grid_start
+        + np.asarray(minutes) * np.timedelta64(60, "s")
+        + np.timedelta64(7, "s")
+    )
+
+
+def test_add_population_minutes_out_of_order():
+    rng = np.random.default_rng(0)
+    minutes = np.sort(rng.choice(500, 300, replace=False))
+    start_times, rates = _start_times(minutes), rng.random(len(minutes))
+    window = 5
+
+    expected = add_population_minutes(*_empty_activity(), start_times, rates, window)
+
+    # minutes arrive in random batches, including minutes before the current grid start
+    activity = _empty_activity()
+    for batch in np.array_split(rng.permutation(len(minutes)), 7):
+        activity = add_population_minutes(
+            *activity, start_times[batch], rates[batch], window
+        )
+
+    grid_start, population_firing_vector, smoothed_firing_vector, offsets = activity
+    assert grid_start == expected[0]
+    np.testing.assert_allclose(population_firing_vector, expected[1])
+    np.testing.assert_allclose(smoothed_firing_vector, expected[2])
+    np.testing.assert_array_equal(offsets, expected[3])
+
+    # trailing mean over `window` minutes (as bottleneck.move_mean with min_count=1)
+    trailing_mean = [
+        population_firing_vector[max(i - window + 1, 0) : i + 1].mean()
+        for i in range(len(population_firing_vector))
+    ]
+    np.testing.assert_allclose(smoothed_firing_vector, trailing_mean)
+
+
+def test_add_population_minutes_fills_gap():
+    window = 3
+    activity = add_population_minutes(
+        *_empty_activity(), _start_times([0, 1, 3, 4]), np.ones(4), window
+    )
+    # the late minute 2 is added although later minutes are already included
+    grid_start, population_firing_vector, smoothed_firing_vector, offsets = (
+        add_population_minutes(*activity, _start_times([2]), [4.0], window)
+    )
+
+    np.testing.assert_allclose(population_firing_vector, [1, 1, 4, 1, 1])
+    np.testing.assert_allclose(smoothed_firing_vector, [1, 1, 2, 2, 2])
+    np.testing.assert_array_equal(offsets, np.arange(5) * 60 + 7)
+
+
+def test_detect_spikes_matches_find_peaks():
+    rng = np.random.default_rng(0)
+    traces = rng.normal(scale=10, size=(20000, 8))
+    fs, threshold_uV, refractory_period = 20000, 30, 0.002
+
+    for peak_sign, signal in [
+        ("pos", traces),
+        ("neg", -traces),
+        ("both", np.abs(traces)),
+    ]:
+        noise_levels, spike_indices, spike_amps = detect_spikes(
+            traces, fs, threshold_uV, peak_sign, refractory_period
+        )
+        thresholds = np.maximum(threshold_uV, 5 * noise_levels)
+        for ch_idx in range(traces.shape[1]):
+            expected, _ = find_peaks(
+                signal[:, ch_idx],
+                height=thresholds[ch_idx],
+                distance=int(refractory_period * fs),
+            )
+            np.testing.assert_array_equal(spike_indices[ch_idx], expected)
+            np.testing.assert_array_equal(spike_amps[ch_idx], traces[expected, ch_idx])
+
+
+def test_select_by_distance_ties():
+    rng = np.random.default_rng(0)
+    signal = np.round(rng.normal(scale=2, size=20000))
+    distance = 10
+    positions, _ = find_peaks(signal, height=3)
+    priority = signal[positions]
+    keep = select_by_distance(positions, priority, distance)
+
+    # kept peaks respect the distance, removed peaks are within `distance` of a kept peak
+    # that is higher, or as high and earlier
+    kept = positions[keep]
+    assert np.all(np.diff(kept) >= distance)
+    for position, height in zip(positions[~keep], priority[~keep]):
+        close = np.abs(kept - position) < distance
+        assert np.any(
+            close
+            & ((signal[kept] > height) | ((signal[kept] == height) & (kept < position)))
+        )
+
+    # equal-height peaks closer than `distance` keep the earlier one
+    keep = select_by_distance(np.array([1, 3, 8]), np.array([5.0, 5.0, 5.0]), 3)
+    np.testing.assert_array_equal(keep, [True, False, True])